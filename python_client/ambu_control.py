@@ -1,12 +1,19 @@
 import time
 import threading
+import collections
 import math
 import sys
 import traceback
 import message
 import comm
 import queue
+import numpy
 import npfifo
+import stream
+import session_log
+import breath
+import latency
+import device_clock
 
 
 
@@ -28,14 +35,23 @@ class AmbuControl(object):
                   'Warn9V'       : 0x08, 'VolInh'      : 0x10, 'AlarmPresLow' : 0x20,
                   'WarnPeepMin'  : 0x40 }
 
-    def __init__(self):
+    # Longest wait between forced reconnects while the stream is stalled
+    MaxBackoff = 8.0
 
-        self._ser = comm.Comm() #serial.Serial(port=dev, baudrate=57600, timeout=1.0)
+    # Seconds between latency and device clock summaries in the log events
+    LatencyLogPeriod = 60.0
+
+    def __init__(self, ser=None, stallTime=0.5):
+
+        # anything with readPackets() and write(), a comm.Comm by default
+        if ser is None: ser = comm.Comm() #serial.Serial(port=dev, baudrate=57600, timeout=1.0)
+        self._ser = ser
         #self._queue = queue.LifoQueue(1)
         self._runEn = False
         self._dataCallBack  = self._debugCallBack
         self._configCallBack = None
         self._file = None
+        self._closing = []
         self._last = None
 
         self._respRate = 0
@@ -49,31 +65,91 @@ class AmbuControl(object):
         self._runState = 0
 
         self._status = 0
-        self._prevmillis=0
-        self._stime = 0
-        self._smillis = -1
+        self._stime = None
         self._refresh = time.time()
         self._version='unknown'
         self._cpuid=[0]*4
         self.artime = 0
-        self._tOffset=0
-        self._timestamp = time.time()
+        # device millis to the fifo time axis, and against host time
+        self._clock = device_clock.DeviceClock()
         self._cfgSerialNum = 0
         self._queue=None
+        self._decoder = stream.Decoder()
+
+        # rows: time, count, press, flow, vol
+        self._data = npfifo.npfifo(5,6000,6000)
+
+        # per breath PIP, PEEP, tidal volume, I:E and rate
+        self.breaths = breath.BreathAnalyzer()
+
+        # threshold change points, (time, volInThold, pipMax, volMax, peepMin)
+        # with time on the fifo time axis
+        self._thresholds = collections.deque(maxlen=1000)
+
+        # per stage latency from serial read to screen, the GUI adds its own
+        # stages, and the host time of the read of the newest committed data
+        self.latency = latency.Latency()
+        self._rxTime = 0
+        self._latencyLog = time.time()
+
+        # stream watchdog: seconds without DATA before a gap is declared
+        self.stallTime = stallTime
+        self.reconnects = 0
+        self._lastRx = None
+        self._lastMillis = 0
+        self._lastCount = 0
+        self._gap = None
+        self._gaps = collections.deque(maxlen=1000)
+        self._gapCallBack = None
+        self._backoff = 0
+        self._nextReconnect = 0
+
+    def openLog(self, fName, maxBytes=0, maxSeconds=0):
+        # The file is opened and written by the log writer thread
+        self._file = session_log.LogWriter(fName, self._logHeader, maxBytes=maxBytes, maxSeconds=maxSeconds)
 
-        self._data = npfifo.npfifo(9,6000)
+    def closeLog(self):
+        # Returns at once, the writer writes out what is queued in the
+        # background and stop() waits for it
+        f, self._file = self._file, None
+        if f is None: return
+        f.close()
+        self._closing = [w for w in self._closing if w.alive] + [f]
+
+    def _joinLogs(self, timeout=5.0):
+        for f in self._closing:
+            f.join(timeout)
+        self._closing = []
+
+    def _logHeader(self):
+        config = (self._respRate, self._inhTime, self._pipMax, self._pipOffset,
+                  self._volMax, self._volFactor, self._volInThold, self._peepMin)
+        return { 'cpuid' : self._cpuid, 'version' : self._version, 'config' : config,
+                 'runState' : self._runState, 'cfgSerial' : self._cfgSerialNum }
 
-    def openLog(self, fName):
-        self._file = open(fName,'a')
+    @property
+    def logDrops(self):
+        f = self._file
+        return 0 if f is None else f.drops
 
-    def closeLog(self):
-        self._file.close()
-        self._file = None
+    @property
+    def logBacklog(self):
+        f = self._file
+        return 0 if f is None else f.backlog
+
+    @property
+    def logError(self):
+        f = self._file
+        return None if f is None else f.error
 
     def _debugCallBack(self,data,count,*args):
         l = len(self._data.get_i())
         print(f"Got data. Len={l} count={count}")
 
+    def appendData(self, block):
+        # block is a (5, k) array of samples in npfifo row order
+        self._data.append_many(block)
+
     def setDataCallBack(self, callBack):
         self._dataCallBack = callBack
 
@@ -83,6 +159,40 @@ class AmbuControl(object):
     def setConfigCallBack(self, callBack):
         self._configCallBack = callBack
 
+    def setGapCallBack(self, callBack):
+        # called from the serial thread with each gap record once data resumes
+        self._gapCallBack = callBack
+
+    @property
+    def thresholds(self):
+        # Threshold change points, oldest first, each (time, volInThold,
+        # pipMax, volMax, peepMin). A value holds until the next point.
+        return list(self._thresholds)
+
+    def _thresholdChanged(self):
+        point = (self._clock.last, self._volInThold, self._pipMax, self._volMax, self._peepMin)
+        if self._thresholds and self._thresholds[-1][1:] == point[1:]:
+            return
+        self._thresholds.append(point)
+
+    @property
+    def clock(self):
+        # the device clock model, skew, drift and sample rate
+        return self._clock
+
+    @property
+    def gaps(self):
+        # Recorded data gaps, oldest first. Each is a dict with start and end
+        # host times, duration, lostSamples (from millis), lostBreaths (from
+        # count), reconnects and reset (the device restarted meanwhile).
+        return list(self._gaps)
+
+    @property
+    def stalled(self):
+        # Seconds since the last DATA packet while a gap is open, else 0
+        if self._gap is None: return 0
+        return time.time() - self._gap['start']
+
     @property
     def version(self):
         return self._version
@@ -116,6 +226,7 @@ class AmbuControl(object):
     @pipMax.setter
     def pipMax(self,value):
         self._pipMax = value
+        self._thresholdChanged()
         m=message.Message()
         data=m.writeData(m.PARAM_FLOAT,0,[self._pipMax],[self.ConfigKey['SetPipMax']]);
         self._ser.write(data)
@@ -138,6 +249,7 @@ class AmbuControl(object):
     @volMax.setter
     def volMax(self,value):
         self._volMax = value
+        self._thresholdChanged()
         m=message.Message()
         data=m.writeData(m.PARAM_FLOAT,0,[self._volMax],[self.ConfigKey['SetVolMax']])
         self._ser.write(data)
@@ -160,6 +272,7 @@ class AmbuControl(object):
     @volInThold.setter
     def volInThold(self,value):
         self._volInThold = value
+        self._thresholdChanged()
         m=message.Message()
         data=m.writeData(m.PARAM_FLOAT,0,[self._volInThold],[self.ConfigKey['SetVolInThold']])
         self._ser.write(data)
@@ -171,6 +284,7 @@ class AmbuControl(object):
     @peepMin.setter
     def peepMin(self,value):
         self._peepMin = value
+        self._thresholdChanged()
         m=message.Message()
         data=m.writeData(m.PARAM_FLOAT,0,[self._peepMin],[self.ConfigKey['SetPeepMin']])
         self._ser.write(data)
@@ -235,7 +349,7 @@ class AmbuControl(object):
 #        while self._runEn:
 #            try:
 #                # need to block with timeout - otherwise wait is uninterruptible on Windows
-#                (data, count, rate, stime, artime, volMax, pipMax) = self._queue.get(block=True,timeout=1)
+#                (data, count, rate, stime, artime, volMax, pipMax, thresholds, rxTime) = self._queue.get(block=True,timeout=1)
 #                self._dataCallBack(count, rate, stime, artime, volMax, pipMax)
 #                self._plotCallBack(data)
 #            except:
@@ -244,6 +358,8 @@ class AmbuControl(object):
     def stop(self):
         self._runEn = False
         self._thread.join()
+        self.closeLog()
+        self._joinLogs()
 
 
     def start(self):
@@ -254,17 +370,92 @@ class AmbuControl(object):
 
 
     def _handleSerial(self):
-        counter=0
         while self._runEn:
-            line=self._ser.readPacket()
-            if(line is None): continue
-            ts = time.time()
-            m=message.Message()
-            try:
-                m.decode(line)
-            except:
+            packets=self._ser.readPackets()
+            if packets:
+                self._handlePackets(packets)
+            if self._watchdog(time.time()):
+                self._reconnect()
+
+    def _reconnect(self):
+        # transports without disconnect() reconnect on their own, if at all
+        if hasattr(self._ser,'disconnect'):
+            self._ser.disconnect()
+
+    def _watchdog(self, now):
+        # Opens a gap once DATA has been missing for stallTime and returns
+        # True when the transport should be reconnected, with the wait
+        # between attempts doubling up to MaxBackoff
+        if self._lastRx is None:
+            return False
+        if self._gap is None:
+            if now - self._lastRx < self.stallTime:
+                return False
+            self._gap = { 'start' : self._lastRx, 'millis' : self._lastMillis,
+                          'count' : self._lastCount, 'resets' : self._clock.resets, 'reconnects' : 0 }
+            self._backoff = self.stallTime
+            self._nextReconnect = now
+        if now < self._nextReconnect:
+            return False
+        self._gap['reconnects'] += 1
+        self.reconnects += 1
+        self._nextReconnect = now + self._backoff
+        self._backoff = min(2*self._backoff, self.MaxBackoff)
+        return True
+
+    def _rxData(self, rec, ts):
+        millis = int(rec['millis'][0])
+        count  = int(rec['count'][0])
+        if self._gap is not None:
+            self._closeGap(ts, millis, count)
+        self._lastRx = ts
+        self._lastMillis = int(rec['millis'][-1])
+        self._lastCount = int(rec['count'][-1])
+
+    def _rxLatency(self, t, ts):
+        # age of every sample when read, against the host time the device
+        # clock fit gives it
+        self.latency.stages['device'].addMany(ts - self._clock.host(t))
+
+    def _closeGap(self, ts, millis, count):
+        g = self._gap
+        self._gap = None
+        duration = ts - g['start']
+        elapsed = ((millis - g['millis']) & 0xffffffff) / 1000.
+        period = self._clock.period
+        reset = self._clock.resets != g['resets']
+        lostBreaths = count if reset else max(0, count - g['count'])
+        if period is None:
+            # no sample period known yet, nothing to count the loss in
+            lostSamples = 0
+        elif reset:
+            lostSamples = max(0, round((duration - millis/1000.) / period))
+        else:
+            lostSamples = max(0, round(elapsed / period) - 1)
+        gap = { 'start' : g['start'], 'end' : ts, 'duration' : duration, 'lostSamples' : lostSamples,
+                'lostBreaths' : lostBreaths, 'reconnects' : g['reconnects'], 'reset' : reset }
+        self._gaps.append(gap)
+        # read once, closeLog() may clear it from another thread
+        f = self._file
+        if f is not None:
+            f.event('gap', **gap)
+        if self._gapCallBack is not None:
+            self._gapCallBack(gap)
+
+    def _handlePackets(self,packets):
+        ts = time.time()
+        blocks=[]
+        for m in self._decoder.items(packets):
+            if type(m) is not message.Message:
+                # a run of DATA packets as a record array
+                self.latency.add('decode',time.time()-ts)
+                t=self._clock.update(m['millis'],ts)
+                self._rxLatency(t,ts)
+                self._rxData(m,ts)
+                if self._cfgSerialNum != 0:
+                    block=self._handleData(m,t,ts)
+                    if block is not None: blocks.append(block)
                 continue
-            if(m.status!=m.ERR_OK): continue
             if(m.id == m.VERSION):
                 self._version=m.string
             if(m.id == m.CPU_ID and m.nInt==4):
@@ -283,62 +474,65 @@ class AmbuControl(object):
                     self._volInThold  = m.floatData[6]
                     self._peepMin     = m.floatData[7]
                     self._runState    = m.intData[0]
+                    self._thresholdChanged()
 
                     if (self._configCallBack is not None):
                         self._configCallBack()
 
-            elif self._cfgSerialNum != 0 and m.id == m.DATA and m.nFloat==5 and m.nInt==2:
-                #print(f"Got status: {line.rstrip()}")
-                millis = m.millis
-                data=  m.floatData
-                idata  = m.intData
-                count  = idata[0]
-                status = idata[1]
-                volMax = data[0]
-                pipMax = data[1]
-                press  = data[2]
-                flow   = data[3]
-                vol    = data[4]
-
-                self._status = status
-
-                if self._smillis == -1:
-                    self._smillis=millis
-                    self._stime = time.time()
-                    continue
-                else:
-                    # handle overflow and arduino reset case
-                    if(millis<self._prevmillis):
-                        self._smillis=millis
-                        reboot_time=time.time()-self._timestamp
-                        #we could count resets here
-                        self._tOffset=self._diffT+reboot_time
-                        self._timestamp=time.time()
-                        self._prevmillis=millis
-                        continue
-                    diffT=(millis-self._smillis)/1000.+self._tOffset
-                    if(diffT<=0): continue
-                    self._diffT=diffT
-                    self._timestamp=time.time()
-                    self._prevmillis=millis
-                stime  = ts - self._stime
-                artime= millis/1000.
-                self._data.append([diffT, count, press, flow, vol, self.volInThold, self.pipMax, self.volMax, self.peepMin])
-
-                if self._file is not None:
-                    self._file.write(f'{ts}, {status}, {count}, {press}, {flow}, {vol}\n')
-
-                if time.time() - self._refresh > 0.08:
-                    self._refresh = time.time()
-
-                    num_points = self._data.get_n()
-                    denom= (self._data.A[0,-1] - self._data.get_nextout_time())
-                    if denom!=0:
-                        rate = num_points / (self._data.A[0,-1] - self._data.get_nextout_time())
-                    else:
-                        rate=0
-                    qe=[self._data, count, rate, stime, artime, volMax, pipMax]
-                    try:
-                        self._queue.put(qe,block=False)
-                    except:
-                        pass
+        if not blocks: return
+
+        # commit everything decoded from this read in one write
+        for block in blocks:
+            self.appendData(block)
+        self._rxTime = ts
+        self.latency.add('commit',time.time()-ts)
+
+        if time.time() - self._refresh > 0.08:
+            self._refresh = time.time()
+            f = self._file
+            if f is not None and self._refresh - self._latencyLog > self.LatencyLogPeriod:
+                self._latencyLog = self._refresh
+                f.event('latency', **self.latency.stats())
+                f.event('clock', **self._clock.stats())
+
+            (count, stime, artime, volMax, pipMax) = self._last
+            rate = self._clock.rate
+            qe=[self._data.snapshot(), count, rate, stime, artime, volMax, pipMax, self.thresholds, self._rxTime]
+            try:
+                # an entry the GUI has not taken yet is stale, replace it
+                self._queue.get(block=False)
+            except:
+                pass
+            try:
+                self._queue.put(qe,block=False)
+            except:
+                pass
+
+    def _handleData(self,rec,t,ts):
+        # t is the time axis of the samples, from the device clock
+        self._status = int(rec['status'][-1])
+        if self._stime is None: self._stime = ts
+
+        last=rec[-1]
+        stime  = ts - self._stime
+        artime = int(last['millis'])/1000.
+        self._last = (int(last['count']), stime, artime, float(last['volMax']), float(last['pipMax']))
+
+        self.breaths.update(t,rec)
+
+        block=numpy.empty((5,len(rec)))
+        block[0]=t
+        block[1]=rec['count']
+        block[2]=rec['press']
+        block[3]=rec['flow']
+        block[4]=rec['vol']
+
+        f = self._file
+        if f is not None:
+            log=numpy.empty(len(rec),dtype=session_log.RECORD_DTYPE)
+            log['ts']=ts
+            for name in ('millis','status','count','press','flow','vol'):
+                log[name]=rec[name]
+            f.write(log)
+
+        return block
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+import ambu_control
+import async_comm
+
+
+class AsyncAmbuControl(ambu_control.AmbuControl):
+    # AmbuControl driven by an asyncio event loop. Several of these, plus any
+    # other coroutines, can share one loop through run(). start()/stop() and
+    # the property setters keep working for threaded callers.
+
+    def __init__(self, ser=None, maxBlocks=100, stallTime=0.5):
+        if ser is None: ser = async_comm.AsyncComm()
+        super().__init__(ser, stallTime)
+        self._maxBlocks = maxBlocks
+        self._blocks = None
+        self._configChanged = None
+        self._thread = None
+
+    async def run(self):
+        self._configChanged = asyncio.Event()
+        self._runEn = True
+        await self._ser.start()
+        self.requestConfig()
+        try:
+            while self._runEn:
+                try:
+                    # wake up now and then to notice stop() and stalls
+                    packets = await asyncio.wait_for(self._ser.readPackets(),min(1,self.stallTime/2))
+                except asyncio.TimeoutError:
+                    packets = None
+                if packets:
+                    serial = self._cfgSerialNum
+                    self._handlePackets(packets)
+                    if serial != self._cfgSerialNum:
+                        self._configChanged.set()
+                if self._watchdog(time.time()) and hasattr(self._ser,'disconnect'):
+                    await self._ser.disconnect()
+        finally:
+            await self._ser.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncio.run, args=(self.run(),))
+        self._thread.start()
+
+    def stop(self):
+        self._runEn = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.closeLog()
+        self._joinLogs()
+
+    def appendData(self, block):
+        super().appendData(block)
+        if self._blocks is None: return
+        if self._blocks.full():
+            # slow consumer, drop the oldest block
+            self._blocks.get_nowait()
+        self._blocks.put_nowait(block)
+
+    async def samples(self):
+        # Yields each (5, k) block of samples as it is committed to the fifo
+        if self._blocks is None:
+            self._blocks = asyncio.Queue(self._maxBlocks)
+        while True:
+            yield await self._blocks.get()
+
+    async def _waitConfig(self, serial, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._cfgSerialNum == serial:
+            self._configChanged.clear()
+            try:
+                await asyncio.wait_for(self._configChanged.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _setConfig(self, name, value, timeout):
+        # Returns True once the device has echoed a new config serial number
+        serial = self._cfgSerialNum
+        setattr(self, name, value)
+        await self._ser.drain()
+        return await self._waitConfig(serial, timeout)
+
+    async def setRespRate(self, value, timeout=2.0):
+        return await self._setConfig('respRate', value, timeout)
+
+    async def setInhTime(self, value, timeout=2.0):
+        return await self._setConfig('inhTime', value, timeout)
+
+    async def setPipMax(self, value, timeout=2.0):
+        return await self._setConfig('pipMax', value, timeout)
+
+    async def setPipOffset(self, value, timeout=2.0):
+        return await self._setConfig('pipOffset', value, timeout)
+
+    async def setVolMax(self, value, timeout=2.0):
+        return await self._setConfig('volMax', value, timeout)
+
+    async def setVolFactor(self, value, timeout=2.0):
+        return await self._setConfig('volFactor', value, timeout)
+
+    async def setVolInThold(self, value, timeout=2.0):
+        return await self._setConfig('volInThold', value, timeout)
+
+    async def setPeepMin(self, value, timeout=2.0):
+        return await self._setConfig('peepMin', value, timeout)
+
+    async def setRunState(self, value, timeout=2.0):
+        return await self._setConfig('runState', value, timeout)
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import comm
+import stream
+
+
+class AsyncComm:
+    # asyncio transport for one ventilator. Port discovery is done by
+    # comm.Comm in an executor, after that a reader task frames incoming
+    # bytes and a writer task drains queued commands.
+    def __init__(self, port=None, cacheFile=comm.CACHE_FILE):
+        # port and cacheFile as for comm.Comm
+        self._comm=comm.Comm(port=port,cacheFile=cacheFile)
+        self._framer=stream.Framer()
+        self._loop=None
+        self._rx=None
+        self._tx=None
+        self._tasks=[]
+        self._connecting=False
+
+    @property
+    def id(self):
+        return self._comm.id
+
+    @property
+    def port(self):
+        return self._comm.port
+
+    @property
+    def connects(self):
+        return self._comm.connects
+
+    async def start(self):
+        self._loop=asyncio.get_running_loop()
+        self._rx=asyncio.Queue()
+        self._tx=asyncio.Queue()
+        self._tasks=[asyncio.ensure_future(self._reader()),
+                     asyncio.ensure_future(self._writer())]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks,return_exceptions=True)
+        self._tasks=[]
+
+    async def connect(self):
+        self._connecting=True
+        try:
+            await self._loop.run_in_executor(None,self._comm.connect)
+        finally:
+            self._connecting=False
+        self._framer.clear()
+        # frames the connect read after the CPU_ID
+        if self._comm._packets:
+            self._rx.put_nowait(list(self._comm._packets))
+            self._comm._packets.clear()
+
+    async def disconnect(self):
+        # Drops the port and restarts the reader, which connects again. A
+        # connect already under way is left to finish.
+        if self._connecting: return
+        reader=self._tasks[0]
+        reader.cancel()
+        await asyncio.gather(reader,return_exceptions=True)
+        self._comm.disconnect()
+        self._framer.clear()
+        self._tasks[0]=asyncio.ensure_future(self._reader())
+
+    async def readPackets(self):
+        return await self._rx.get()
+
+    def write(self,data):
+        # Safe to call from any thread, the writer task does the I/O. On the
+        # loop thread the command is queued at once, so a drain() right
+        # after waits for it.
+        if self._loop is None: return
+        try:
+            running=asyncio.get_running_loop()
+        except RuntimeError:
+            running=None
+        if running is self._loop:
+            self._tx.put_nowait(data)
+        else:
+            self._loop.call_soon_threadsafe(self._tx.put_nowait,data)
+
+    async def send(self,data):
+        await self._tx.put(data)
+
+    async def drain(self):
+        await self._tx.join()
+
+    async def _reader(self):
+        while True:
+            ser=self._comm._ser
+            if ser is None:
+                await self.connect()
+                if self._comm._ser is None:
+                    await asyncio.sleep(1)
+                continue
+            try:
+                data=await self._read(ser)
+            except asyncio.CancelledError:
+                raise
+            except:
+                # close the port, the next pass connects again
+                self._comm.disconnect()
+                self._framer.clear()
+                continue
+            frames=self._framer.frames(data)
+            if frames:
+                self._rx.put_nowait(frames)
+
+    async def _read(self,ser):
+        if os.name=='posix' and hasattr(ser,'fileno'):
+            # wait on the file descriptor, then take what is waiting
+            fd=ser.fileno()
+            ready=self._loop.create_future()
+            self._loop.add_reader(fd,ready.set_result,None)
+            try:
+                await ready
+            finally:
+                self._loop.remove_reader(fd)
+            return ser.read(max(1,ser.in_waiting))
+        # no selectable handle, e.g. Windows: use the blocking read in a thread
+        return await self._loop.run_in_executor(None,ser.read,max(1,ser.in_waiting))
+
+    async def _writer(self):
+        while True:
+            data=await self._tx.get()
+            try:
+                if self._comm._ser is not None:
+                    self._comm._ser.write(data)
+            except:
+                # the reader may be waiting on the port, it is restarted too
+                await self.disconnect()
+            finally:
+                self._tx.task_done()
@@ -0,0 +1,172 @@
+import threading
+import numpy
+
+# One row per completed breath. Times are on the AmbuControl fifo time axis,
+# pressures in cmH2O, volumes in mL, flows in L/min.
+BREATH_DTYPE = numpy.dtype([('count','<u4'),('start','<f8'),('duration','<f4'),('ti','<f4'),('te','<f4'),
+                            ('ie','<f4'),('rate','<f4'),('pip','<f4'),('peep','<f4'),('vt','<f4'),
+                            ('flowMax','<f4'),('flowMin','<f4')])
+
+# Cycle states that count as inspiration are StateOn and StateHold, so
+# everything but StateOff
+_STATE_OFF = 0
+
+
+class BreathAnalyzer:
+    # Segments the sample stream into breaths on changes of the firmware
+    # breath count and keeps a record table of the completed ones. Blocks of
+    # the breath in progress are only queued, most reads carry a packet or
+    # two, and reduced into a handful of accumulators together at the end of
+    # the breath or every FoldBlocks blocks. The breath in progress when the
+    # stream starts, and any breath cut by a count jump or a device reset,
+    # is dropped.
+
+    # queued blocks reduced at once in a long breath
+    FoldBlocks = 64
+
+    def __init__(self, maxBreaths=10000, peepSamples=5):
+        self._rec = numpy.zeros(maxBreaths, dtype=BREATH_DTYPE)
+        self._n = 0              # rows in the table
+        self._total = 0          # breaths recorded, the table keeps the newest
+        self._peepSamples = peepSamples
+        self._lock = threading.Lock()
+        self._count = None
+        self._open = False
+        self._start = 0.0
+        self._tiEnd = None
+        self._pip = self._vt = 0.0
+        self._flowMax = self._flowMin = 0.0
+        self._tail = numpy.zeros(0)
+        self._pending = []
+
+    def clear(self):
+        with self._lock:
+            self._n = 0
+            self._total = 0
+        self._count = None
+        self._open = False
+        self._pending = []
+
+    @property
+    def breaths(self):
+        # number of breaths recorded since the start or the last clear(),
+        # more than records() holds once the table has filled
+        return self._total
+
+    def update(self, t, rec):
+        # t is the sample time, rec a message.DATA_DTYPE record array
+        count = rec['count']
+        if len(count) == 0:
+            return
+        if count[0] == count[-1] and count[0] == self._count:
+            # most blocks are inside one breath
+            if self._open:
+                self._queue(t, rec)
+            return
+        bounds = numpy.flatnonzero(count[1:] != count[:-1]) + 1
+        starts = numpy.concatenate(([0], bounds))
+        ends = numpy.concatenate((bounds, [len(count)]))
+        for a, b in zip(starts, ends):
+            c = int(count[a])
+            if c != self._count:
+                self._next(c, t[a])
+            if self._open:
+                self._queue(t[a:b], rec[a:b])
+
+    def _queue(self, t, rec):
+        self._pending.append((t, rec))
+        if len(self._pending) >= self.FoldBlocks:
+            self._fold()
+
+    def _fold(self):
+        if not self._pending:
+            return
+        if len(self._pending) == 1:
+            t, rec = self._pending[0]
+        else:
+            # field by field, joining whole records is far slower
+            t = numpy.concatenate([p[0] for p in self._pending])
+            rec = { name : numpy.concatenate([p[1][name] for p in self._pending])
+                    for name in ('press','flow','vol','status') }
+        self._pending = []
+        self._accumulate(t, rec)
+
+    def _next(self, count, t):
+        if self._open and count == self._count + 1:
+            self._fold()
+            self._close(t)
+        # the first breath seen is only partly seen
+        self._open = self._count is not None and count == self._count + 1
+        self._count = count
+        self._start = t
+        self._tiEnd = None
+        self._pip = self._vt = 0.0
+        self._flowMax = self._flowMin = 0.0
+        self._tail = numpy.zeros(0)
+        self._pending = []
+
+    def _accumulate(self, t, rec):
+        press = rec['press']
+        flow = rec['flow']
+        self._pip = max(self._pip, float(press.max()))
+        self._vt = max(self._vt, float(rec['vol'].max()))
+        self._flowMax = max(self._flowMax, float(flow.max()))
+        self._flowMin = min(self._flowMin, float(flow.min()))
+        if self._tiEnd is None:
+            # inspiration ends at the first sample out of StateOn/StateHold
+            out = numpy.flatnonzero(((rec['status'] >> 24) & 0xff) == _STATE_OFF)
+            if len(out):
+                self._tiEnd = float(t[out[0]])
+        if len(press) >= self._peepSamples:
+            self._tail = press[-self._peepSamples:].copy()
+        else:
+            self._tail = numpy.concatenate((self._tail, press))[-self._peepSamples:]
+
+    def _close(self, end):
+        duration = end - self._start
+        if duration <= 0:
+            return
+        ti = (self._tiEnd if self._tiEnd is not None else end) - self._start
+        te = duration - ti
+        r = (self._count, self._start, duration, ti, te, ti/te if te > 0 else 0.0, 60.0/duration,
+             self._pip, float(self._tail.mean()) if len(self._tail) else 0.0, self._vt,
+             self._flowMax, self._flowMin)
+        with self._lock:
+            if self._n == len(self._rec):
+                # full, keep the newest half
+                half = len(self._rec) // 2
+                self._rec[:half] = self._rec[self._n-half:self._n]
+                self._n = half
+            self._rec[self._n] = r
+            self._n += 1
+            self._total += 1
+
+    def records(self, n=None):
+        # Copy of the last n breath records, all of them by default
+        with self._lock:
+            first = 0 if n is None else max(0, self._n - n)
+            return self._rec[first:self._n].copy()
+
+    def last(self):
+        with self._lock:
+            return self._rec[self._n-1].copy() if self._n else None
+
+    def stats(self, n=10):
+        # Mean, standard deviation and coefficient of variation of each
+        # field over the last n breaths, the breath to breath variability
+        rec = self.records(n)
+        if len(rec) == 0:
+            return {}
+        out = {}
+        for name in ('duration','ti','te','ie','rate','pip','peep','vt'):
+            v = rec[name].astype(numpy.float64)
+            mean = v.mean()
+            std = v.std()
+            out[name] = { 'mean' : float(mean), 'std' : float(std), 'cv' : float(std/mean) if mean else 0.0 }
+        return out
+
+    def export(self, fName):
+        # Writes the record table as CSV, one breath per line
+        rec = self.records()
+        numpy.savetxt(fName, rec, delimiter=',', header=','.join(BREATH_DTYPE.names), comments='',
+                      fmt=['%d','%.3f'] + ['%.4g'] * (len(BREATH_DTYPE.names) - 2))
@@ -0,0 +1,61 @@
+import numpy
+
+# Measurements for the bench check on the Calibration and Test tab, taken
+# from the samples and breath records AmbuControl already keeps.
+
+# pressure, cmH2O, taken as the end of a leak down
+LEAK_FLOOR = 0.5
+
+# s, a slower decay than this is reported as no leak at all
+MAX_TAU = 1000.0
+
+
+def cycleStats(rec):
+    # rec is a breath.BREATH_DTYPE array of the cycles to summarize
+    if len(rec) == 0:
+        return None
+    pip = rec['pip'].astype(numpy.float64)
+    return { 'n'      : len(rec),
+             'pip'    : float(pip.mean()),
+             'pipStd' : float(pip.std()),
+             'pipMin' : float(pip.min()),
+             'pipMax' : float(pip.max()),
+             'peep'   : float(rec['peep'].mean()),
+             'rate'   : float(rec['rate'].mean()),
+             'ti'     : float(rec['ti'].mean()),
+             'ie'     : float(rec['ie'].mean()),
+             'vt'     : float(rec['vt'].mean()) }
+
+
+def leakPeak(press):
+    # index of the pressure peak the leak down starts from
+    return int(numpy.argmax(press)) if len(press) else None
+
+
+def leakTimeConstant(t, press, floor=LEAK_FLOOR):
+    # Time constant of the pressure decay after the peak, from a straight
+    # line fit of log(press) against time. Returns (tau, p0), tau is inf when
+    # the pressure does not measurably fall, None when there is too little
+    # to fit.
+    i = leakPeak(press)
+    if i is None:
+        return None
+    t = t[i:]
+    p = press[i:]
+    sel = p > floor
+    if numpy.count_nonzero(sel) < 3:
+        return None
+    t = t[sel] - t[0]
+    slope, icept = numpy.polyfit(t, numpy.log(p[sel]), 1)
+    p0 = float(numpy.exp(icept))
+    if slope > -1.0/MAX_TAU:
+        return float('inf'), p0
+    return float(-1.0/slope), p0
+
+
+def leakTime(tau, p0, floor=LEAK_FLOOR):
+    # time for the fitted decay to reach floor, what the operator used to
+    # read off the plot as the time to reach 0
+    if p0 <= floor:
+        return 0.0
+    return tau * numpy.log(p0 / floor)
@@ -1,5 +1,5 @@
-
 import sys
+import argparse
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore    import *
@@ -7,8 +7,25 @@ from PyQt5.QtGui     import *
 QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
 import control_gui
 import ambu_control
-ambu = ambu_control.AmbuControl()
-appTop = QApplication(sys.argv)
+import comm
+import replay
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--replay', help='play back a raw capture or session log instead of a device')
+parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 for as fast as possible')
+parser.add_argument('--loop', action='store_true', help='restart the replay when it ends')
+parser.add_argument('--port', help='serial port to use instead of scanning, e.g. one opened by simulator.py')
+parser.add_argument('--capture', help='save the raw bytes read from the device to this file')
+args, qtArgs = parser.parse_known_args()
+
+if args.replay:
+    ser = replay.ReplayComm(args.replay, speed=args.speed, loop=args.loop)
+else:
+    ser = comm.Comm(port=args.port)
+    if args.capture: ser.setCapture(args.capture)
+
+ambu = ambu_control.AmbuControl(ser)
+appTop = QApplication(sys.argv[:1]+qtArgs)
 font=appTop.font()
 font.setPointSizeF(12)
 appTop.setFont(font)
@@ -19,3 +36,4 @@ guiTop.show()
 ambu.start()
 appTop.exec_()
 ambu.stop()
+
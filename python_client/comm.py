@@ -1,72 +1,224 @@
 import serial
 import serial.tools.list_ports
 import io
+import os
+import json
+import time
+import threading
+import concurrent.futures
+import collections
 import message
+import stream
 import traceback
 
+# Longest a connect() waits for a CPU_ID, over all ports together
+PROBE_DEADLINE = 3.0
+
+# Serial read timeout, short so the AmbuControl watchdog sees a silent port
+READ_TIMEOUT = 0.1
+
+# Ports and USB serial numbers of the units seen before
+CACHE_FILE = os.path.join(os.path.expanduser("~"),".ambu_ports.json")
+
+# AmbuControl.ConfigKey['GetConfig'], the firmware answers any command
+# with CONFIG, VERSION and CPU_ID at once
+GET_CONFIG = 0
+
+def candidatePorts():
+    # (port, USB serial number) of the USB serial adapters that may have a
+    # ventilator on them
+    ports = list(serial.tools.list_ports.comports())
+    found = []
+    for port in ports:
+        port_no=port.device
+        description=port.description
+        vid=port.vid
+        pid=port.pid
+        if(vid==0x2341): continue #skip nano USN
+        if (
+                'USB-Serial' in description or
+                'USB-to-Serial' in description or
+                'USB Serial' in description
+            ):
+            found.append((port_no,port.serial_number))
+    return found
+
+def scanPorts():
+    return [port_no for port_no,serialNo in candidatePorts()]
+
+class PortCache:
+    # Remembers which CPU ID answered on which port and USB adapter. The
+    # adapter serial number survives a USB re-enumeration that renames the
+    # port.
+    def __init__(self, fName=CACHE_FILE):
+        self.fName=fName
+        self._ports={}
+        self._serials={}
+        if fName is None: return
+        try:
+            with open(fName) as f:
+                data=json.load(f)
+            self._ports=data.get('ports',{})
+            self._serials=data.get('serials',{})
+        except (OSError,ValueError):
+            pass
+
+    def lookup(self, port_no, serialNo=None):
+        cpuid=self._serials.get(serialNo) if serialNo else None
+        if cpuid is None: cpuid=self._ports.get(port_no)
+        return tuple(cpuid) if cpuid is not None else None
+
+    def store(self, port_no, serialNo, cpuid):
+        cpuid=list(cpuid)
+        if self._ports.get(port_no)==cpuid and (not serialNo or self._serials.get(serialNo)==cpuid):
+            return
+        self._ports[port_no]=cpuid
+        if serialNo: self._serials[serialNo]=cpuid
+        if self.fName is None: return
+        try:
+            tmp=self.fName+'.tmp'
+            with open(tmp,'w') as f:
+                json.dump({'ports':self._ports,'serials':self._serials},f)
+            os.replace(tmp,self.fName)
+        except OSError:
+            pass
+
 class Comm:
-    def __init__(self):
+    def __init__(self, port=None, deadline=PROBE_DEADLINE, cacheFile=CACHE_FILE):
         self._ser=None
+        # fixed port to use, otherwise USB serial adapters are scanned
+        self._port=port
+        self._deadline=deadline
+        self._cache=PortCache(cacheFile)
         self.port=None
         self.id=None
         self.connects=0
-    def connect(self):
-        self.connects=self.connects+1
-        ports = list(serial.tools.list_ports.comports())
-        for port in ports:
-            port_no=port.device
-            description=port.description
-            vid=port.vid
-            pid=port.pid
-            if(vid==0x2341): continue #skip nano USN
-            if (
-                    'USB-Serial' in description or
-                    'USB-to-Serial' in description or
-                    'USB Serial' in description
-                ):
-                try:
-                    ser=serial.Serial(port=port_no, baudrate=57600, timeout=1)
-                except:
-                    return
-                for i in range(1000):
+        self._framer=stream.Framer()
+        self._packets=collections.deque()
+        self._capture=None
+    def setCapture(self,fName):
+        # Saves every byte read from the port, for replay.ReplayComm
+        if self._capture is not None: self._capture.close()
+        self._capture=open(fName,'ab') if fName else None
+    def _ports(self):
+        if self._port is not None: return [(self._port,None)]
+        return candidatePorts()
+    def _probe(self,port_no,known,deadline,stop):
+        # Waits on one port for a CPU_ID. Returns (ser, cpuid, framer,
+        # frames after the CPU_ID) or None.
+        try:
+            ser=serial.Serial(port=port_no, baudrate=57600, timeout=0.1)
+        except:
+            return None
+        try:
+            framer=stream.Framer()
+            # a unit seen on this port before is asked for its id rather
+            # than waited for, unknown devices are only listened to
+            if known: ser.write(message.Message().writeData(message.Message.PARAM_SET,0,[],[GET_CONFIG]))
+            while time.time()<deadline and not stop.is_set():
+                frames=framer.frames(ser.read(max(1,ser.in_waiting)))
+                for i,frame in enumerate(frames):
                     m=message.Message()
-                    self._ser=ser
-                    line=self.readPacket()
-                    self._ser=None
-                    if line is None: continue
                     try:
-                        m.decode(line)
+                        m.decode(frame)
                     except: continue
-                    if(m.status!=m.ERR_OK): continue
-                    if(m.id==m.CPU_ID and m.nInt==4):
-                        self._ser=ser
-                        self.port=port_no
-                        self.id=m.intData
-                        break
-            if self._ser:                
-                return
+                    if(m.status==m.ERR_OK and m.id==m.CPU_ID and m.nInt==4):
+                        return ser,tuple(m.intData),framer,frames[i+1:]
+        except:
+            pass
+        ser.close()
+        return None
+    def connect(self):
+        # Probes every candidate port at once until PROBE_DEADLINE. The first
+        # unit to answer is taken, after that only the unit with the same CPU
+        # ID; a new Comm is needed to change units.
+        self.connects=self.connects+1
+        ports=self._ports()
+        if not ports: return
+        deadline=time.time()+self._deadline
+        stop=threading.Event()
+        pool=concurrent.futures.ThreadPoolExecutor(max_workers=len(ports))
+        futures={pool.submit(self._probe,port_no,self._cache.lookup(port_no,serialNo) is not None,deadline,stop):
+                 (port_no,serialNo) for port_no,serialNo in ports}
+        found=[]
+        try:
+            for f in concurrent.futures.as_completed(futures,timeout=max(0,deadline-time.time())+1):
+                r=f.result()
+                if r is None: continue
+                found.append((r,)+futures[f])
+                if self.id is None or r[1]==self.id: break
+        except concurrent.futures.TimeoutError:
+            pass
+        stop.set()
+        pool.shutdown(wait=False)
+        if self.id is not None:
+            # once connected only the same unit is taken again, the data and
+            # log of one unit must not carry on with another's
+            found=[x for x in found if x[0][1]==self.id]
+        best=found[0] if found else None
+        def discard(f):
+            r=f.result()
+            if r is not None and (best is None or r is not best[0]): r[0].close()
+        # the ports not chosen, including probes still finishing, are closed
+        for f in futures:
+            f.add_done_callback(discard)
+        if best is None:
+            return
+        (ser,cpuid,framer,frames),port_no,serialNo=best
+        ser.timeout=READ_TIMEOUT
+        self._framer=framer
+        self._packets.clear()
+        self._packets.extend(frames)
+        self._ser=ser
+        self.port=port_no
+        self.id=cpuid
+        self._cache.store(port_no,serialNo,cpuid)
 
-    def readPacket(self):
-        if(self._ser is None): self.connect()
-        if(self._ser is None): return
-        l=''
-        while(True):
+    def disconnect(self):
+        # Drops the port, the next read connects again
+        if self._ser is not None:
             try:
-                c = self._ser.read().decode('UTF-8')
+                self._ser.close()
             except:
-                self._ser=None
-                return None
-            if(c!='-'):
-                l=l+c
-            else:
-                return l
+                pass
+        self._ser=None
+        self._framer.clear()
+        self._packets.clear()
+
+    def readPacket(self):
+        if not self._packets:
+            self._packets.extend(self.readPackets())
+        if self._packets:
+            return self._packets.popleft()
+        return None
+
+    def readPackets(self):
+        if(self._ser is None): self.connect()
+        # frames read by connect() after the CPU_ID come first
+        if self._packets:
+            frames=list(self._packets)
+            self._packets.clear()
+            return frames
+        if(self._ser is None): return []
+        try:
+            # block for the first byte, then take everything already waiting
+            data=self._ser.read(max(1,self._ser.in_waiting))
+        except:
+            # close the port, the next read connects again
+            self.disconnect()
+            return []
+        if self._capture is not None: self._capture.write(data)
+        return self._framer.frames(data)
 
     def write(self,data):
-        if self._ser is None: self.connect()
-        else:
-            try:
-                self._ser.write(data)
-            except:
-                self._ser=None
+        # Called from other threads than the reader. Only the reader
+        # connects, while there is no port the command is dropped; a failed
+        # port is left for the reader to notice and replace.
+        ser=self._ser
+        if ser is None: return
+        try:
+            ser.write(data)
+        except:
+            pass
 
     
@@ -10,6 +10,10 @@ import pyqtgraph as pg
 
 
 import ambu_control
+import calibration
+import decimate
+import latency
+import status_model
 import time
 import traceback
 
@@ -60,10 +64,6 @@ class PowerSwitch(QPushButton):
 
 class ControlGui(QWidget):
 
-    updateCount       = pyqtSignal(str)
-    updateRate        = pyqtSignal(str)
-    updateTime        = pyqtSignal(str)
-
     updateRespRate    = pyqtSignal(str)
     updateInhTime     = pyqtSignal(str)
     updatePipMax      = pyqtSignal(str)
@@ -75,16 +75,39 @@ class ControlGui(QWidget):
     updateState       = pyqtSignal(int)
 
     updateVersion     = pyqtSignal(str)
-    updateArTime      = pyqtSignal(str)
-    updateCycVolMax   = pyqtSignal(str)
-    updateCycPipMax   = pyqtSignal(str)
 
-    updateAlarmPipMax  = pyqtSignal(str)
-    updateAlarmVolLow  = pyqtSignal(str)
-    updateAlarm12V     = pyqtSignal(str)
-    updateWarn9V       = pyqtSignal(str)
-    updateAlarmPresLow = pyqtSignal(str)
-    updateWarnPeepMin  = pyqtSignal(str)
+    # the status fields that changed since the last frame, see status_model
+    updateStatus      = pyqtSignal(dict)
+
+    AlarmStyles = { status_model.LEVEL_ALARM   : """QLineEdit { background-color: red; color: black }""",
+                    status_model.LEVEL_WARNING : """QLineEdit { background-color: yellow; color: black }""",
+                    status_model.LEVEL_CLEAR   : """QLineEdit { background-color: lime; color: black }""" }
+
+    # fifo rows drawn by curve[0], curve[4] and curve[5]: pressure, flow
+    # and volume
+    PlotRows = [2,3,4]
+    SampleCurves = [0,4,5]
+
+    # (threshold point field, curve) for the step lines: volInThold is
+    # P-thresh-low, pipMax P-thresh-high, volMax V-thresh-high
+    ThresholdCurves = [(2,1),(1,2),(4,3),(3,6)]
+
+    # Calibration steps by instruction index. The paddle is put up (Relay
+    # Force Off) or set cycling (Relay Run On), the leak check waits with
+    # the paddle up then holds it down, and each PIP check runs cycles with
+    # the valve set to the given PIP.
+    CalPaddleUp    = (1,2,5,7,9,11,12)
+    CalCycling     = (3,13,14)
+    CalLeak        = 4
+    CalPipChecks   = {6:40, 8:30, 10:20}
+    CalSummary     = 11
+    CalCycles      = 10    # cycles measured per PIP check
+    CalSettle      = 1     # cycles skipped after the paddle starts
+    CalTimeout     = 60.0  # s, a PIP check ends with the cycles it has
+    CalLeakWait    = 5.0   # s paddle up before the leak check
+    CalLeakTime    = 5.0   # s of leak down fitted
+    CalLeakTimeout = 15.0  # s, a leak check ends with what it has
+    CalLeakMin     = 10.0  # s, a faster leak down means a circuit leak
 
     def __init__(self, *, ambu, refPlot=False, parent=None):
         super(ControlGui, self).__init__(parent)
@@ -95,6 +118,13 @@ class ControlGui(QWidget):
         self.ambu.setConfigCallBack(self.configUpdated)
         self._queue=queue.Queue(1)
         self.ambu.setQueue(self._queue)
+        self._plotSeq = -1
+        self._plotBuf = None
+        self._breaths = 0
+        self._status = status_model.StatusModel()
+        self.statusWidgets = {}
+        self.updateStatus.connect(self.applyStatus)
+        self._latencyUpdate = 0
         self.respRate     = None
         self.inhTime      = None
         self.volInhThold  = None
@@ -137,8 +167,9 @@ class ControlGui(QWidget):
         self.plot[0]=self.gl.addPlot(row=1,col=1)
         self.plot[1]=self.gl.addPlot(row=2,col=1)
         self.plot[2]=self.gl.addPlot(row=3,col=1)
-        item=pg.PlotItem()
-        self.hidden=item.plot(pen=pg.mkPen("w"))
+        # the legend spacer curve needs its PlotItem kept alive
+        self.hiddenItem=pg.PlotItem()
+        self.hidden=self.hiddenItem.plot(pen=pg.mkPen("w"))
 
         self.plot[0].setLabel('bottom',"Time",color='black')
         self.plot[1].setLabel('bottom',"Time",color='black')
@@ -176,6 +207,10 @@ class ControlGui(QWidget):
         self.curve[4]=self.plot[1].plot(pen=pg.mkPen("g",width=width),name="Flow")
         self.curve[5]=self.plot[2].plot(pen=pg.mkPen("b",width=width),name="Volume")
         self.curve[6]=self.plot[2].plot(pen=pg.mkPen("r",width=width),name="V-thresh-high")
+        for c in self.curve:
+            # values are bounded, and without the limit check moving a curve
+            # does not redo its display data
+            c.setDynamicRangeLimit(None)
 
         legend[0].addItem(self.curve[0],"Pressure")
         legend[0].addItem(self.curve[1],"P-thresh-high")
@@ -189,6 +224,10 @@ class ControlGui(QWidget):
         for i in range(5): legend[2].addItem(self.hidden,"")
         top.addWidget(self.gl,66)
 
+        # the render latency is taken when the plot is painted
+        self._renderRx = None
+        self.gl.viewport().installEventFilter(self)
+
         # Controls on left
         gb = QGroupBox('Control')
         left.addWidget(gb)
@@ -250,18 +289,21 @@ class ControlGui(QWidget):
         gb.setLayout(fl)
 
         #this will be a switch that will display true and turn red if any of the alarm conditions are met.  Hovering or looking at expert page will say which.  maybe even alarms settings page? or just alarm settings group box on expert page?
-        #fl.addRow('Alarm Status:',self.alarmStatus)
+        self.alarmStatus = QLineEdit()
+        self.alarmStatus.setText("Clear")
+        self.alarmStatus.setReadOnly(True)
+        fl.addRow('Alarm Status:',self.alarmStatus)
 
         cycVolMax = QLineEdit()
         cycVolMax.setText("0")
         cycVolMax.setReadOnly(True)
-        self.updateCycVolMax.connect(cycVolMax.setText)
+        self.statusField('volMax',cycVolMax)
         fl.addRow('Max Volume (mL):',cycVolMax)
 
         cycPipMax = QLineEdit()
         cycPipMax.setText("0")
         cycPipMax.setReadOnly(True)
-        self.updateCycPipMax.connect(cycPipMax.setText)
+        self.statusField('pipMax',cycPipMax)
         fl.addRow('Max Pip (cmH20):',cycPipMax)
 
         cycleRunTime=QLineEdit()
@@ -274,7 +316,7 @@ class ControlGui(QWidget):
         cycles = QLineEdit()
         cycles.setText("0")
         cycles.setReadOnly(True)
-        self.updateCount.connect(cycles.setText)
+        self.statusField('count',cycles)
         fl.addRow('Breaths:',cycles)
         # I think we want breaths since cycle start rather than software start?
 
@@ -369,73 +411,109 @@ class ControlGui(QWidget):
         alarmPipMax = QLineEdit()
         alarmPipMax.setText("0")
         alarmPipMax.setReadOnly(True)
-        self.updateAlarmPipMax.connect(alarmPipMax.setText)
+        self.statusField('alarmPipMax',alarmPipMax)
         fl.addRow('Pip Max Alarm:',alarmPipMax)
 
         alarmVolLow = QLineEdit()
         alarmVolLow.setText("0")
         alarmVolLow.setReadOnly(True)
-        self.updateAlarmVolLow.connect(alarmVolLow.setText)
+        self.statusField('alarmVolLow',alarmVolLow)
         fl.addRow('Vol Low Alarm:',alarmVolLow)
 
         alarm12V = QLineEdit()
         alarm12V.setText("0")
         alarm12V.setReadOnly(True)
-        self.updateAlarm12V.connect(alarm12V.setText)
+        self.statusField('alarm12V',alarm12V)
         fl.addRow('12V Alarm:',alarm12V)
 
         warn9V = QLineEdit()
         warn9V.setText("0")
         warn9V.setReadOnly(True)
-        self.updateWarn9V.connect(warn9V.setText)
+        self.statusField('warn9V',warn9V)
         fl.addRow('9V Alarm:',warn9V)
 
         alarmPresLow = QLineEdit()
         alarmPresLow.setText("0")
         alarmPresLow.setReadOnly(True)
-        self.updateAlarmPresLow.connect(alarmPresLow.setText)
+        self.statusField('alarmPresLow',alarmPresLow)
         fl.addRow('Press Low Alarm:',alarmPresLow)
 
         warnPeepMin = QLineEdit()
         warnPeepMin.setText("0")
         warnPeepMin.setReadOnly(True)
-        self.updateWarnPeepMin.connect(warnPeepMin.setText)
+        self.statusField('warnPeepMin',warnPeepMin)
         fl.addRow('Peep Min Warning:',warnPeepMin)
 
         cycles = QLineEdit()
         cycles.setText("0")
         cycles.setReadOnly(True)
-        self.updateCount.connect(cycles.setText)
+        self.statusField('count',cycles)
         fl.addRow('Breaths:',cycles)
 
         sampRate = QLineEdit()
         sampRate.setText("0")
         sampRate.setReadOnly(True)
-        self.updateRate.connect(sampRate.setText)
+        self.statusField('rate',sampRate)
         fl.addRow('Sample Rate:',sampRate)
 
+        clock = QLineEdit()
+        clock.setReadOnly(True)
+        self.statusField('clock',clock)
+        fl.addRow('Device Clock:',clock)
+
+        # latency from serial read, milliseconds p50 / p99 / max
+        for stage in latency.STAGES:
+            lat = QLineEdit()
+            lat.setReadOnly(True)
+            self.statusField('latency.'+stage,lat)
+            fl.addRow(f'Latency {stage.capitalize()} (ms):',lat)
+
+        stream = QLineEdit()
+        stream.setText("OK")
+        stream.setReadOnly(True)
+        self.statusField('stream',stream)
+        fl.addRow('Data Stream:',stream)
+
+        gaps = QLineEdit()
+        gaps.setText("0")
+        gaps.setReadOnly(True)
+        self.statusField('gaps',gaps)
+        fl.addRow('Data Gaps:',gaps)
+
+        lastGap = QLineEdit()
+        lastGap.setText("")
+        lastGap.setReadOnly(True)
+        self.statusField('lastGap',lastGap)
+        fl.addRow('Last Gap:',lastGap)
+
+        reconnects = QLineEdit()
+        reconnects.setText("0")
+        reconnects.setReadOnly(True)
+        self.statusField('reconnects',reconnects)
+        fl.addRow('Reconnects:',reconnects)
+
         cycVolMax = QLineEdit()
         cycVolMax.setText("0")
         cycVolMax.setReadOnly(True)
-        self.updateCycVolMax.connect(cycVolMax.setText)
+        self.statusField('volMax',cycVolMax)
         fl.addRow('Max Volume (mL):',cycVolMax)
 
         cycPipMax = QLineEdit()
         cycPipMax.setText("0")
         cycPipMax.setReadOnly(True)
-        self.updateCycPipMax.connect(cycPipMax.setText)
+        self.statusField('pipMax',cycPipMax)
         fl.addRow('Max Pip (cmH20):',cycPipMax)
 
         timeSinceStart=QLineEdit()
         timeSinceStart.setText("0")
         timeSinceStart.setReadOnly(True)
-        self.updateTime.connect(timeSinceStart.setText)
+        self.statusField('stime',timeSinceStart)
         fl.addRow('Seconds since start:',timeSinceStart)
 
         arduinoUptime=QLineEdit()
         arduinoUptime.setText("0")
         arduinoUptime.setReadOnly(True)
-        self.updateArTime.connect(arduinoUptime.setText)
+        self.statusField('artime',arduinoUptime)
         fl.addRow('Arduino uptime (s):',arduinoUptime)
 
         guiVersion = QLineEdit()
@@ -467,6 +545,23 @@ class ControlGui(QWidget):
         self.selectLog=pb
         fl.addRow('Log File:',self.logFile)
 
+        logBacklog = QLineEdit()
+        logBacklog.setText("0")
+        logBacklog.setReadOnly(True)
+        self.statusField('logBacklog',logBacklog)
+        fl.addRow('Log Backlog:',logBacklog)
+
+        logDrops = QLineEdit()
+        logDrops.setText("0")
+        logDrops.setReadOnly(True)
+        self.statusField('logDrops',logDrops)
+        fl.addRow('Log Drops:',logDrops)
+
+        logError = QLineEdit()
+        logError.setReadOnly(True)
+        self.statusField('logError',logError)
+        fl.addRow('Log Error:',logError)
+
         pb = QPushButton('Begin Recording Data')
         pb.clicked.connect(self.openPressed)
         self.beginLog=pb
@@ -477,13 +572,68 @@ class ControlGui(QWidget):
         self.endLog=pb
         vl.addWidget(pb)
 
+        # Breath Analysis
+        gb = QGroupBox('Breath Analysis')
+        left.addWidget(gb)
+
+        vl = QVBoxLayout()
+        gb.setLayout(vl)
+
+        fl = QFormLayout()
+        fl.setRowWrapPolicy(QFormLayout.DontWrapRows)
+        fl.setFormAlignment(Qt.AlignHCenter | Qt.AlignTop)
+        fl.setLabelAlignment(Qt.AlignRight)
+        vl.addLayout(fl)
+
+        breathRate = QLineEdit()
+        breathRate.setText("0")
+        breathRate.setReadOnly(True)
+        self.statusField('breathRate',breathRate)
+        fl.addRow('Measured Rate:',breathRate)
+
+        pip = QLineEdit()
+        pip.setText("0")
+        pip.setReadOnly(True)
+        self.statusField('pip',pip)
+        fl.addRow('PIP (cmH20):',pip)
+
+        peep = QLineEdit()
+        peep.setText("0")
+        peep.setReadOnly(True)
+        self.statusField('peep',peep)
+        fl.addRow('PEEP (cmH20):',peep)
+
+        tidalVol = QLineEdit()
+        tidalVol.setText("0")
+        tidalVol.setReadOnly(True)
+        self.statusField('tidalVol',tidalVol)
+        fl.addRow('Tidal Volume (mL):',tidalVol)
+
+        ieRatio = QLineEdit()
+        ieRatio.setText("")
+        ieRatio.setReadOnly(True)
+        self.statusField('ieRatio',ieRatio)
+        fl.addRow('I:E:',ieRatio)
+
+        rateCv = QLineEdit()
+        rateCv.setText("0")
+        rateCv.setReadOnly(True)
+        self.statusField('rateCv',rateCv)
+        fl.addRow('Rate Variability (%):',rateCv)
+
+        pb = QPushButton('Export Breath Table')
+        pb.clicked.connect(self.exportBreaths)
+        vl.addWidget(pb)
+
         self.plotData = []
         self.rTime = time.time()
         self.beginLog.setEnabled(False)
         self.endLog.setEnabled(False)
 
     def setupPageThree(self):
-        self.timeoutabort=0
+        self._calStep=None
+        self._calData=None
+        self._calPip={}
         top = QHBoxLayout()
         self.tab3.setLayout(top)
 
@@ -610,61 +760,169 @@ class ControlGui(QWidget):
         gb_results.setMinimumWidth(450)
         gb_results.setMinimumHeight(300)
 
-        results_hbox = QVBoxLayout()
-        gb_results.setLayout(results_hbox)
+        fl = QFormLayout()
+        fl.setRowWrapPolicy(QFormLayout.DontWrapRows)
+        fl.setFormAlignment(Qt.AlignHCenter | Qt.AlignTop)
+        fl.setLabelAlignment(Qt.AlignRight)
+        gb_results.setLayout(fl)
+
+        self.calStatus = QLineEdit()
+        self.calStatus.setReadOnly(True)
+        fl.addRow('Step Status:',self.calStatus)
+
+        self.leakTau = QLineEdit()
+        self.leakTau.setReadOnly(True)
+        fl.addRow('Leak Time Constant (s):',self.leakTau)
+
+        self.leakTime = QLineEdit()
+        self.leakTime.setReadOnly(True)
+        fl.addRow('Leak Down Time (s):',self.leakTime)
+
+        self.pipCheck = {}
+        for target in sorted(self.CalPipChecks.values(),reverse=True):
+            self.pipCheck[target] = QLineEdit()
+            self.pipCheck[target].setReadOnly(True)
+            fl.addRow(f'PIP at {target} (cmH20):',self.pipCheck[target])
+
+        self.calRate = QLineEdit()
+        self.calRate.setReadOnly(True)
+        fl.addRow('Cycle Rate (bpm):',self.calRate)
+
+        self.calIe = QLineEdit()
+        self.calIe.setReadOnly(True)
+        fl.addRow('Cycle I:E:',self.calIe)
+
+        self.calVt = QLineEdit()
+        self.calVt.setReadOnly(True)
+        fl.addRow('Cycle Volume (mL):',self.calVt)
 
-        #results_hbox.addLayout(nameofthing)
         self.doInit=True
         self.line=[None]*7
 
     def performAction(self):
+        # Sets the paddle for the current step and starts its measurement.
+        # Nothing here waits, timed and measuring steps are moved on by
+        # calibrationTick() from the display timer.
+        self._calStep=None
         try:
-            if self.index == 1 or self.index == 2 or self.index == 5 or self.index == 7  or self.index == 9 or self.index == 11 or self.index == 12:
-                self.textfield.setText(str(self.index)+") "+self.textfield.toPlainText()+"\n\nState: Paddle up")
+            text=str(self.index)+") "+self.instructions[self.index]
+            if self.index in self.CalPaddleUp:
+                self.textfield.setText(text+"\n\nState: Paddle up")
                 self.stateControl.setCurrentIndex(0)
 
-            if self.index == 3 or self.index == 13 or self.index == 14:
-                self.textfield.setText(str(self.index)+") "+self.textfield.toPlainText()+"\n\nState: Paddle cycling")
+            if self.index in self.CalCycling:
+                self.textfield.setText(text+"\n\nState: Paddle cycling")
                 self.stateControl.setCurrentIndex(3)
 
-            if self.index == 4:
-                self.textfield.setText(str(self.index)+") "+self.textfield.toPlainText()+"\n\nState: Paddle up for 5 seconds, then Paddle down")
+            if self.index == self.CalLeak:
+                self.textfield.setText(text+f"\n\nState: Paddle up for {self.CalLeakWait:.0f} seconds, then Paddle down; measuring the leak down.  Results will appear below.")
                 self.stateControl.setCurrentIndex(0)
-                sleeptime=5
-                sleeptimer=0
-                self.timeoutabort=0
-                while sleeptimer<sleeptime:
-                    time.sleep(0.1)
-                    QCoreApplication.processEvents()
-                    if self.timeoutabort>0:
-                        break
-                    sleeptimer=sleeptimer+0.1
-                if self.timeoutabort==0:
-                    self.stateControl.setCurrentIndex(1)
-
-            if self.index == 6 or self.index == 8 or self.index == 10:
-                self.textfield.setText(str(self.index)+") "+self.textfield.toPlainText()+"\n\nState: Running 10 cycles; calculating observed PIP from pressure plot.  Results will appear below.")
+                self._calBegin('wait',self.CalLeakWait)
+
+            if self.index in self.CalPipChecks:
+                self.textfield.setText(text+f"\n\nState: Running {self.CalCycles} cycles; measuring observed PIP.  Results will appear below.")
                 self.stateControl.setCurrentIndex(3)
-                sleeptime=30
-                sleeptimer=0
-                self.timeoutabort=0
-                while sleeptimer<sleeptime:
-                    time.sleep(0.1)
-                    QCoreApplication.processEvents()
-                    if self.timeoutabort>0:
-                        break
-                    sleeptimer=sleeptimer+0.1
-                if self.timeoutabort==0:
-                    self.stateControl.setCurrentIndex(0)
+                self._calBegin('pip',self.CalTimeout)
 
+            if self.index == self.CalSummary:
+                self.textfield.setText(self.textfield.toPlainText()+"\n\n"+self.calSummary())
 
         except Exception as e:
             print(f"Got GUI value error {e}")
 
+    def _calBegin(self, step, duration):
+        self._calStep=step
+        self._calDeadline=time.time()+duration
+        self._calCount=self.ambu.breaths.breaths
+        self._calT0=None if self._calData is None else self._calData.get_last_time()
+
+    def _calSamples(self):
+        # time and pressure since the step started, from the last snapshot
+        d=None if self._calData is None else self._calData.get_data()
+        if d is None or self._calT0 is None: return None
+        sel=d[0]>self._calT0
+        t=d[0,sel].copy()
+        p=d[2,sel].copy()
+        if not self._calData.valid(): return None
+        return t,p
+
+    def calibrationTick(self):
+        if self._calStep is None: return
+        try:
+            now=time.time()
+            if self._calStep == 'wait':
+                if now < self._calDeadline:
+                    self.calStatus.setText(f"Paddle down in {self._calDeadline-now:.0f} s")
+                    return
+                self.stateControl.setCurrentIndex(1)
+                self._calBegin('leak',self.CalLeakTimeout)
+            elif self._calStep == 'leak':
+                self._leakTick(now)
+            elif self._calStep == 'pip':
+                self._pipTick(now)
+        except Exception as e:
+            self._calStep=None
+            print(f"Got GUI value error {e}")
+
+    def _leakTick(self, now):
+        s=self._calSamples()
+        if s is not None and len(s[0]):
+            t,p=s
+            i=calibration.leakPeak(p)
+            decay=t[-1]-t[i]
+            self.calStatus.setText(f"Leak down {decay:.1f} s")
+            # enough decay to fit, or already down at the floor
+            done=decay >= self.CalLeakTime or (decay > 0 and p[-1] <= calibration.LEAK_FLOOR)
+            if not done and now < self._calDeadline: return
+        elif now < self._calDeadline:
+            return
+        self._calStep=None
+        r=None if s is None else calibration.leakTimeConstant(*s)
+        if r is None:
+            self.calStatus.setText("Leak check: no pressure")
+            self.leakTau.setText("")
+            self.leakTime.setText("")
+            return
+        tau,p0=r
+        lt=calibration.leakTime(tau,p0)
+        self.calStatus.setText("Leak check done")
+        self.leakTau.setText(f"{tau:.1f}")
+        self.leakTime.setText(f"{lt:.1f} "+("OK" if lt >= self.CalLeakMin else "LEAK"))
+
+    def _pipTick(self, now):
+        n=self.ambu.breaths.breaths-self._calCount
+        self.calStatus.setText(f"{max(0,n-self.CalSettle)}/{self.CalCycles} cycles")
+        if n < self.CalCycles+self.CalSettle and now < self._calDeadline: return
+        # enough cycles, or the time is up and the ones there are will do
+        self._calStep=None
+        self.stateControl.setCurrentIndex(0)
+        rec=self.ambu.breaths.records(n)[self.CalSettle:] if n > 0 else []
+        stats=calibration.cycleStats(rec)
+        target=self.CalPipChecks[self.index]
+        self._calPip[target]=stats
+        if stats is None:
+            self.calStatus.setText("PIP check: no cycles")
+            self.pipCheck[target].setText("")
+            return
+        self.calStatus.setText(f"PIP check done, {stats['n']} cycles")
+        self.pipCheck[target].setText(f"{stats['pip']:.1f} \u00b1 {stats['pipStd']:.1f} ({stats['pipMin']:.1f} - {stats['pipMax']:.1f})")
+        self.calRate.setText(f"{stats['rate']:.1f}")
+        self.calIe.setText(f"1:{1/stats['ie']:.1f}" if stats['ie'] > 0 else "")
+        self.calVt.setText(f"{stats['vt']:.0f}")
+
+    def calSummary(self):
+        lines=[]
+        for target in sorted(self.CalPipChecks.values(),reverse=True):
+            stats=self._calPip.get(target)
+            if stats is None:
+                lines.append(f"PIP set {target} cm H2O: not measured")
+            else:
+                lines.append(f"PIP set {target} cm H2O: observed {stats['pip']:.1f} ({stats['pip']-target:+.1f}) over {stats['n']} cycles")
+        return "\n".join(lines)
+
     @pyqtSlot()
     def nextPressed(self):
         try:
-            self.timeoutabort=1
             if self.index < self.instlength-1:
                 self.index=self.index+1
                 self.textfield.setText(self.instructions[self.index])
@@ -675,7 +933,6 @@ class ControlGui(QWidget):
     @pyqtSlot()
     def prevPressed(self):
         try:
-            self.timeoutabort=1
             if self.index > 0:
                 self.index=self.index-1
                 self.textfield.setText(self.instructions[self.index])
@@ -686,7 +943,6 @@ class ControlGui(QWidget):
     @pyqtSlot()
     def repPressed(self):
         try:
-            self.timeoutabort=1
             self.textfield.setText(self.instructions[self.index])
             self.performAction()
         except Exception as e:
@@ -800,7 +1056,7 @@ class ControlGui(QWidget):
     @pyqtSlot()
     def selectFile(self):
         dlg = QFileDialog()
-        f=dlg.getSaveFileName(self, 'Save ventillator data:')[0]
+        f=dlg.getSaveFileName(self, 'Save ventillator data:', '', 'Session log (*.pabv);;All files (*)')[0]
         if(len(f)>0):
             state=not self.beginLog.isEnabled() and not self.endLog.isEnabled()
             if(state):
@@ -809,6 +1065,19 @@ class ControlGui(QWidget):
             self.logFile.update()
 
 
+    def exportBreaths(self):
+        dlg = QFileDialog()
+        f=dlg.getSaveFileName(self, 'Save breath table:', '', 'CSV (*.csv);;All files (*)')[0]
+        if(len(f)>0):
+            self.ambu.breaths.export(f)
+
+    def breathStatus(self):
+        # the breath fields only need formatting when a breath completed
+        b=self.ambu.breaths
+        if b.breaths == self._breaths: return {}
+        self._breaths=b.breaths
+        return status_model.breathFields(b)
+
     def configUpdated(self):
         self.updateRespRate.emit("{:0.1f}".format(self.ambu.respRate))
         self.updateInhTime.emit("{:0.1f}".format(self.ambu.inhTime))
@@ -828,52 +1097,82 @@ class ControlGui(QWidget):
 
         self.updateVersion.emit(str(self.ambu.version))
 
-    def updateDisplay(self,count,rate,stime,artime,volMax,pipMax):
-        self.updateCount.emit(str(count))
-        self.updateRate.emit(f"{rate:.1f}")
-        self.updateTime.emit(f"{stime:.1f}")
-        self.updateArTime.emit(f"{artime:.1f}")
-        self.updateCycVolMax.emit(f"{volMax:.1f}")
-        self.updateCycPipMax.emit(f"{pipMax:.1f}")
-
-        self.updateAlarmPipMax.emit("{}".format(self.ambu.alarmPipMax))
-        self.updateAlarmVolLow.emit("{}".format(self.ambu.alarmVolLow))
-        self.updateAlarm12V.emit("{}".format(self.ambu.alarm12V))
-        self.updateWarn9V.emit("{}".format(self.ambu.warn9V))
-        self.updateAlarmPresLow.emit("{}".format(self.ambu.alarmPresLow))
-        self.updateWarnPeepMin.emit("{}".format(self.ambu.warnPeepMin))
-        if self.ambu.alarmPipMax or self.ambu.alarmVolLow or self.ambu.alarm12V or self.ambu.alarmPresLow:
-            self.alarmStatus.setStyleSheet("""QLineEdit { background-color: red; color: black }""")
-            self.alarmStatus.setText("Alarm")
-        elif self.ambu.warn9V or self.ambu.warnPeepMin:
-            self.alarmStatus.setStyleSheet("""QLineEdit { background-color: yellow; color: black }""")
-            self.alarmStatus.setText("Warning")
-
-        else:
-            self.alarmStatus.setStyleSheet("""QLineEdit { background-color: lime; color: black }""")
-            self.alarmStatus.setText("Clear")
-
-    def updatePlot(self,inData):
+    def statusField(self, name, widget):
+        # widget shows status field name, several widgets may show one field
+        self.statusWidgets.setdefault(name,[]).append(widget)
+
+    def publishStatus(self, fields):
+        changed=self._status.update(fields)
+        if changed:
+            self.updateStatus.emit(changed)
+
+    def applyStatus(self, changed):
+        for name,value in changed.items():
+            if name == 'alarmLevel':
+                # restyled only when the level changes
+                self.alarmStatus.setStyleSheet(self.AlarmStyles[value])
+                self.alarmStatus.setText(status_model.LEVEL_TEXT[value])
+                continue
+            for w in self.statusWidgets.get(name,()):
+                w.setText(value)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and self._renderRx is not None:
+            self.ambu.latency.add('render',time.time()-self._renderRx)
+            self._renderRx=None
+        return False
+
+    def timingStatus(self):
+        # once a second is plenty for percentiles and the clock fit
+        if time.time() - self._latencyUpdate < 1.0: return {}
+        self._latencyUpdate=time.time()
+        return status_model.timingFields(self.ambu)
+
+    def updatePlot(self,inData,thresholds=()):
+        # Nothing new since the last frame, or the serial thread has already
+        # overwritten this window
+        if inData.seq == self._plotSeq or not inData.valid():
+            return
         ambu_data = inData.get_data()
         if type(ambu_data) == type(None):
             return
-        xa =  ambu_data[0,:]
-        xa=xa-xa[-1]
+        # two points per pixel column are all a plot can show
+        width=int(self.plot[0].getViewBox().width())
+        new=inData.seq-self._plotSeq
+        restart=self._plotBuf is None or self._plotBuf.width != width or self._plotSeq < 0 or new > ambu_data.shape[1]
+        if restart:
+            # start over from the whole window
+            new=ambu_data.shape[1]
+        # only the samples since the last frame are decimated, and the time
+        # axis scrolls by moving the curves rather than rewriting them. The
+        # block is copied first, then checked against a serial thread that
+        # overwrote it meanwhile
+        block=ambu_data[:,-new:].copy()
+        if not inData.valid():
+            return
+        if restart:
+            self._plotBuf=decimate.CurveBuffer(len(self.PlotRows),inData.A.shape[1],width)
+        self._plotSeq = inData.seq
+        self._plotBuf.append(block[0],block[self.PlotRows,:])
         try:
             self.plot[0].setYRange(float(self.pMinValue.text()),float(self.pMaxValue.text()))
             self.plot[1].setYRange(float(self.fMinValue.text()),float(self.fMaxValue.text()))
             self.plot[2].setYRange(float(self.vMinValue.text()),float(self.vMaxValue.text()))
-            data=[None]*7
-            data[0]=ambu_data[2,:]
-            data[1]=ambu_data[6,:]
-            data[2]=ambu_data[5,:]
-            data[3]=ambu_data[8,:]
-            data[4]=ambu_data[3,:]
-            data[5]=ambu_data[4,:]
-            data[6]=ambu_data[7,:]
-
-            for i in range(7):
-                self.curve[i].setData(xa,data[i])
+            data=self._plotBuf.data()
+            if data is None: return
+            x,y=data
+            t=block[0,-1]
+            for i,c in enumerate(self.SampleCurves):
+                self.curve[c].setData(x[i],y[i])
+                self.curve[c].setPos(-t,0)
+            if thresholds:
+                # each value holds from its change point to the next, the
+                # last one up to now
+                tp=np.array(thresholds)
+                tx=np.append(tp[:,0],max(t,tp[-1,0]))
+                for col,c in self.ThresholdCurves:
+                    self.curve[c].setData(tx,tp[:,col],stepMode='center')
+                    self.curve[c].setPos(-t,0)
             #self.gl.update()
         except Exception as e:
             #print(e)
@@ -883,14 +1182,34 @@ class ControlGui(QWidget):
         ts=time.time()
         rate=100
 
+        # stream status runs every tick, the data queue is silent while the
+        # stream stalls
+        status=status_model.streamFields(self.ambu)
+        status.update(self.timingStatus())
         try:
-            (data, count, rate, stime, artime, volMax, pipMax) = self._queue.get(block=False)
-            self.updateDisplay(count,rate,stime,artime,volMax,pipMax)
-            self.updatePlot(data)
-        except:
-            pass
+            entry=self._queue.get(block=False)
+        except queue.Empty:
+            entry=None
+        if entry is None:
+            self.publishStatus(status)
+        else:
+            try:
+                (data, count, srate, stime, artime, volMax, pipMax, thresholds, rxTime) = entry
+                lat=self.ambu.latency
+                lat.add('queue',time.time()-rxTime)
+                status.update(status_model.displayFields(self.ambu,count,srate,stime,artime,volMax,pipMax))
+                status.update(self.breathStatus())
+                self.publishStatus(status)
+                lat.add('display',time.time()-rxTime)
+                self.updatePlot(data,thresholds)
+                if self._plotSeq == data.seq and self.gl.isVisible():
+                    self._renderRx=rxTime
+                self._calData=data
+            except:
+                pass
+        self.calibrationTick()
         dt=(time.time()-self.last_update)*1000
         corr=dt-rate
         if(corr>=(rate/2) or dt>=rate): corr=0
         self.last_update=time.time()
-        QTimer.singleShot(rate-corr, self.updateAll)
+        QTimer.singleShot(int(rate-corr), self.updateAll)
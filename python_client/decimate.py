@@ -0,0 +1,67 @@
+import numpy
+import npfifo
+
+# Plot decimation. A line plot cannot show more than one vertical span per
+# pixel column, so each column only needs the minimum and maximum of the
+# samples that fall in it, kept in the order they occurred.
+
+
+def columnIndex(Y, k):
+    # Y is (rows, f*k). Returns the (rows, 2*f) indices of the min and max of
+    # every column of k samples, in time order
+    rows = Y.shape[0]
+    f = Y.shape[1] // k
+    yb = Y[:,:f*k].reshape(rows,f,k)
+    lo = yb.argmin(axis=2)
+    hi = yb.argmax(axis=2)
+    idx = numpy.empty((rows,f,2),dtype=numpy.intp)
+    idx[:,:,0] = numpy.minimum(lo,hi)
+    idx[:,:,1] = numpy.maximum(lo,hi)
+    idx += (numpy.arange(f)*k)[None,:,None]
+    return idx.reshape(rows,2*f)
+
+
+class CurveBuffer:
+    # Incremental min/max decimation of series sharing a time axis, for a
+    # window of nPoints samples drawn width pixels wide. Samples are folded
+    # into columns as they arrive and the columns kept in an npfifo, so the
+    # cost of a frame follows the number of new samples.
+    def __init__(self, nSeries, nPoints, width):
+        self.width = width
+        self._s = nSeries
+        self._k = max(1, nPoints // width) if width > 0 else 1
+        self._cols = npfifo.npfifo(2*nSeries, 2*(-(-nPoints // self._k)))
+        # samples that do not fill a column yet
+        self._x = numpy.zeros(0)
+        self._Y = numpy.zeros((nSeries,0))
+
+    def append(self, x, Y):
+        # x is (n,) and Y (nSeries, n), oldest sample first
+        if len(self._x):
+            x = numpy.concatenate((self._x, x))
+            Y = numpy.concatenate((self._Y, Y), axis=1)
+        n = len(x) - len(x) % self._k
+        self._x = x[n:].copy()
+        self._Y = Y[:,n:].copy()
+        if n == 0:
+            return
+        idx = columnIndex(Y[:,:n], self._k)
+        block = numpy.empty((2*self._s, idx.shape[1]))
+        block[:self._s] = x[idx]
+        block[self._s:] = numpy.take_along_axis(Y, idx, axis=1)
+        self._cols.append_many(block)
+
+    def data(self):
+        # (x, y), one row per series, or None before the first sample. The
+        # samples that do not fill a column yet are drawn as they are, so the
+        # curves reach the newest sample.
+        d = self._cols.get_data()
+        if d is None:
+            if len(self._x) == 0:
+                return None
+            return numpy.tile(self._x, (self._s,1)), self._Y
+        if len(self._x) == 0:
+            return d[:self._s], d[self._s:]
+        x = numpy.concatenate((d[:self._s], numpy.broadcast_to(self._x, (self._s,len(self._x)))), axis=1)
+        y = numpy.concatenate((d[self._s:], self._Y), axis=1)
+        return x, y
@@ -0,0 +1,219 @@
+import collections
+import numpy
+
+# The device millis counter is 32 bits and wraps after 49.7 days
+MILLIS_WRAP = 1 << 32
+
+
+class DeviceClock:
+    # Turns the millis stamps of the DATA samples into a continuous time
+    # axis, in device seconds since the first sample, and fits that axis
+    # against host time.
+    #
+    # Within a run of the device the axis follows millis, across a 32 bit
+    # rollover too, so it carries none of the host read jitter. When millis
+    # goes backwards without wrapping the device has reset; the axis then
+    # continues from where the host clock says the new samples are.
+    #
+    # The fit is a least squares line of host read time against axis time,
+    # one point per block, with exponential forgetting. Points further than
+    # rejectTime from the line, reads the host got to late, are left out;
+    # after maxRejects in a row the fit starts over, the clock has moved.
+
+    # device seconds between moves of the fit origin
+    RecentreTime = 600.0
+
+    def __init__(self, forget=0.9999, rejectTime=0.05, maxRejects=50, minPoints=20,
+                 rateWindow=200, driftPeriod=600.0):
+        self._forget = forget
+        self._rejectTime = rejectTime
+        self._maxRejects = maxRejects
+        self._minPoints = minPoints
+        self._driftPeriod = driftPeriod
+        self._rateWindow = rateWindow
+        self.clear()
+
+    def clear(self):
+        self._ms = None          # last millis seen
+        self._t = 0.0            # axis time of the last sample
+        self._ts = None          # host read time of the last block
+        self._host0 = None       # host time of axis 0, the fit origin
+        self._samples = 0
+        self._rate = collections.deque(maxlen=self._rateWindow)
+        self._steps = collections.deque(maxlen=self._rateWindow)
+        self._blocks = 0
+        self._period = None
+        self._skewPrev = None
+        self._skewN = 0
+        self.resets = 0
+        self.rollovers = 0
+        self.rejects = 0
+        self.drift = 0.0
+        self._b = 1.0
+        self._restartFit()
+
+    def _restartFit(self):
+        # the slope so far is kept until the new fit has enough points
+        self._n = 0
+        self._sw = self._sx = self._sy = self._sxx = self._sxy = 0.0
+        self._xo = self._yo = 0.0
+        self._a = None
+        self._rejected = 0
+        self._skewT = None
+
+    def _recentre(self, x):
+        # Moves the origin of the sums to x, so they stay small against
+        # their differences however long the device runs
+        dx = x - self._xo
+        dy = self._b * dx
+        sw, sx, sy = self._sw, self._sx, self._sy
+        self._sx  = sx - dx * sw
+        self._sy  = sy - dy * sw
+        self._sxx = self._sxx - 2 * dx * sx + dx * dx * sw
+        self._sxy = self._sxy - dx * sy - dy * sx + dx * dy * sw
+        self._a  += dx * self._b - dy
+        self._xo += dx
+        self._yo += dy
+
+    @property
+    def ready(self):
+        return self._a is not None
+
+    @property
+    def last(self):
+        # axis time of the newest sample
+        return self._t
+
+    @property
+    def skew(self):
+        # host seconds per device second - 1, positive when the device
+        # clock runs slow
+        return self._b - 1.0
+
+    @property
+    def period(self):
+        # device seconds between samples, the median millis step of the last
+        # samples, None until there are two
+        return self._period
+
+    @property
+    def deviceRate(self):
+        # samples per device second over the last blocks without a gap
+        if len(self._rate) < 2:
+            return 0.0
+        t0, n0 = self._rate[0]
+        t1, n1 = self._rate[-1]
+        return (n1 - n0) / (t1 - t0) if t1 > t0 else 0.0
+
+    @property
+    def rate(self):
+        # samples per host second
+        return self.deviceRate / self._b
+
+    def host(self, t):
+        # host time of axis time t
+        if self._host0 is None:
+            return None
+        if self._a is None:
+            return self._host0 + t
+        return self._host0 + self._yo + self._a + self._b * (t - self._xo)
+
+    def axis(self, ts):
+        # axis time of host time ts, the inverse of host()
+        if self._a is not None:
+            return self._xo + (ts - self._host0 - self._yo - self._a) / self._b
+        return self._t + (ts - self._ts)
+
+    def update(self, millis, ts):
+        # millis of one block of samples, oldest first, read at host time ts.
+        # Returns the axis time of every sample, never going backwards.
+        ms = millis.astype(numpy.int64)
+        if self._ms is None:
+            self._ms = int(ms[0])
+            self._ts = ts
+            self._host0 = ts - float(ms[-1] - ms[0]) / 1000.
+        step = numpy.empty_like(ms)
+        step[0] = ms[0] - self._ms
+        numpy.subtract(ms[1:], ms[:-1], out=step[1:])
+        # the checks below are only needed when millis went backwards
+        back = ()
+        if step.min() < 0:
+            wrap = step <= -MILLIS_WRAP // 2
+            if wrap.any():
+                self.rollovers += int(numpy.count_nonzero(wrap))
+                step[wrap] += MILLIS_WRAP
+            back = numpy.flatnonzero(step < 0)
+        t = self._t + step.cumsum() / 1000.
+        # no gap can be told before the sample period is known
+        gap = len(back) > 0 or (self._period is not None and step.max() > 2.5 * 1000. * self._period)
+        self._stepUpdate(step)
+        if len(back):
+            # a device reset, the samples from the last restart on are placed
+            # by the host clock
+            self.resets += 1
+            i = back[-1]
+            t[i:] = self.axis(ts) - (ms[-1] - ms[i:]) / 1000.
+            numpy.maximum.accumulate(t, out=t)
+            numpy.maximum(t, self._t, out=t)
+        self._ms = int(ms[-1])
+        self._t = float(t[-1])
+        self._ts = ts
+        self._samples += len(t)
+        if gap:
+            self._rate.clear()
+        self._rate.append((self._t, self._samples))
+        self._fit(self._t, ts - self._host0)
+        return t
+
+    def _stepUpdate(self, step):
+        # the median is robust to the odd gap among the steps, it is taken
+        # every block until known, then every 32 blocks
+        self._steps.extend(step[step > 0].tolist())
+        self._blocks += 1
+        if self._steps and (self._period is None or self._blocks % 32 == 0):
+            self._period = float(numpy.median(self._steps)) / 1000.
+
+    def _fit(self, x, y):
+        if self._a is not None and abs(self.host(x) - self._host0 - y) > self._rejectTime:
+            self.rejects += 1
+            self._rejected += 1
+            if self._rejected < self._maxRejects:
+                return
+            self._restartFit()
+        self._rejected = 0
+        if self._n == 0:
+            self._xo, self._yo = x, y
+        elif self._a is not None and x - self._xo > self.RecentreTime:
+            self._recentre(x)
+        x -= self._xo
+        y -= self._yo
+        f = self._forget
+        self._sw  = f * self._sw  + 1.0
+        self._sx  = f * self._sx  + x
+        self._sy  = f * self._sy  + y
+        self._sxx = f * self._sxx + x * x
+        self._sxy = f * self._sxy + x * y
+        self._n += 1
+        det = self._sw * self._sxx - self._sx * self._sx
+        if self._n < self._minPoints or det <= 0:
+            return
+        self._b = (self._sw * self._sxy - self._sx * self._sy) / det
+        self._a = (self._sy - self._b * self._sx) / self._sw
+        self._driftUpdate(x + self._xo)
+
+    def _driftUpdate(self, x):
+        # change of the skew, per hour of device time, once the fit has
+        # filled its window
+        if self._n * (1 - self._forget) < 1:
+            return
+        if self._skewT is None:
+            self._skewT, self._skewPrev = x, self.skew
+        elif x - self._skewT >= self._driftPeriod:
+            d = (self.skew - self._skewPrev) / ((x - self._skewT) / 3600.)
+            self.drift = d if self._skewN == 0 else 0.8 * self.drift + 0.2 * d
+            self._skewN += 1
+            self._skewT, self._skewPrev = x, self.skew
+
+    def stats(self):
+        return { 'skewPpm' : 1e6 * self.skew, 'driftPpmPerHour' : 1e6 * self.drift, 'rate' : self.rate,
+                 'resets' : self.resets, 'rollovers' : self.rollovers, 'rejects' : self.rejects }
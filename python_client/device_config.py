@@ -0,0 +1,45 @@
+import message
+from ambu_control import AmbuControl
+
+
+class DeviceConfig:
+    # Host side copy of the firmware AmbuConfig: parameter storage, handling
+    # of PARAM_* commands and the CONFIG/VERSION/CPU_ID packets the firmware
+    # sends. Used by the replay and simulator transports.
+
+    # Defaults from AmbuConfig::setup()
+    Defaults = [20.0, 1.0, 40.0, 0.0, 200.0, 0.5, -2.0, 0.0]
+
+    def __init__(self, cpuid=(0,0,0,0), version=b'unknown', config=None, runState=3, serial=1):
+        self.cpuid = list(cpuid)
+        if isinstance(version,str): version = version.encode()
+        self.version = version
+        self.config = list(config) if config is not None else list(self.Defaults)
+        self.runState = runState
+        self.serial = serial
+        self.muted = False
+
+    def command(self, m):
+        # Applies a decoded command, returns True when the firmware would
+        # bump the serial number and send a new CONFIG
+        if m.status != m.ERR_OK or m.nInt == 0:
+            return False
+        param = m.intData[0]
+        if m.id == m.PARAM_FLOAT and m.nFloat == 1:
+            if AmbuControl.ConfigKey['SetRespRate'] <= param <= AmbuControl.ConfigKey['SetPeepMin']:
+                self.config[param-1] = m.floatData[0]
+        elif m.id == m.PARAM_INTEGER and m.nInt == 2:
+            if param == AmbuControl.ConfigKey['SetRunState']:
+                self.runState = m.intData[1]
+        elif m.id == m.PARAM_SET and m.nFloat == 0 and m.nInt == 1:
+            if param == AmbuControl.ConfigKey['MuteAlarm']:
+                self.muted = True
+        self.serial += 1
+        return True
+
+    def frames(self, millis):
+        # Encoded CONFIG, VERSION and CPU_ID packets, in firmware order
+        m = message.Message()
+        return [m.writeData(m.CONFIG, millis, self.config, [self.runState, self.serial]),
+                m.writeString(m.VERSION, millis, self.version),
+                m.writeData(m.CPU_ID, millis, [], self.cpuid)]
@@ -0,0 +1,205 @@
+import os
+import sys
+import time
+import selectors
+import threading
+import serial
+import stream
+import comm
+from ambu_control import AmbuControl
+
+
+class DevicePort:
+    # One open serial port, used as the AmbuControl transport in place of
+    # comm.Comm. The DeviceManager does the reading, write() goes straight
+    # to the port.
+    def __init__(self, port_no):
+        self.port = port_no
+        self.id = None
+        self.ambu = None
+        self.opened = time.time()
+        self._ser = serial.Serial(port=port_no, baudrate=57600, timeout=0, write_timeout=1)
+        self._framer = stream.Framer()
+
+    def fileno(self):
+        return self._ser.fileno()
+
+    @property
+    def in_waiting(self):
+        return self._ser.in_waiting
+
+    def read(self):
+        return self._framer.frames(self._ser.read(max(1,self._ser.in_waiting)))
+
+    def readPackets(self):
+        # the manager thread reads for every port
+        return []
+
+    def write(self, data):
+        try:
+            self._ser.write(data)
+        except Exception:
+            # the reader drops the port when it is gone
+            pass
+
+    def close(self):
+        try:
+            self._ser.close()
+        except Exception:
+            pass
+
+
+class DeviceManager:
+    # Monitors any number of ventilators from one thread. Every candidate
+    # port is read through a single selector; a port becomes a device once
+    # it sends its CPU_ID. Each CPU ID keeps one AmbuControl, with its data
+    # buffer, config and log, for the life of the manager, so a unit that
+    # comes back on another port carries on where it was.
+    #
+    # The AmbuControl objects are fed by the manager, do not start() them.
+
+    def __init__(self, ports=None, scanPeriod=5.0, probeTime=5.0):
+        # fixed list of ports, otherwise USB serial adapters are scanned
+        self._fixed = ports
+        self._scanPeriod = scanPeriod
+        self._probeTime = probeTime
+        self._ports = {}
+        self._decoder = stream.Decoder()
+        self._poll = os.name == 'posix'
+        self._sel = selectors.DefaultSelector() if self._poll else None
+        self._deviceCallBack = None
+        self._runEn = False
+        self._thread = None
+        self._nextScan = 0
+        self.devices = {}
+
+    def setDeviceCallBack(self, callBack):
+        # called from the manager thread with (cpuid, ambu) for each new unit
+        self._deviceCallBack = callBack
+
+    def device(self, cpuid):
+        return self.devices.get(tuple(cpuid))
+
+    def ports(self):
+        # cpu id -> port name for the units that are connected
+        return { p.id : p.port for p in list(self._ports.values()) if p.id is not None }
+
+    def start(self):
+        self._runEn = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self):
+        self._runEn = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for p in list(self._ports.values()):
+            self._drop(p)
+
+    def scan(self):
+        # Opens candidate ports that are not open yet
+        names = self._fixed if self._fixed is not None else comm.scanPorts()
+        for name in names:
+            if name in self._ports: continue
+            try:
+                p = DevicePort(name)
+            except Exception:
+                continue
+            self._ports[name] = p
+            if self._poll: self._sel.register(p, selectors.EVENT_READ)
+
+    def _drop(self, p):
+        if self._ports.get(p.port) is p:
+            del self._ports[p.port]
+        if self._poll:
+            try:
+                self._sel.unregister(p)
+            except (KeyError, ValueError):
+                pass
+        p.close()
+
+    def _ready(self, timeout):
+        if self._poll:
+            return [key.fileobj for key, mask in self._sel.select(timeout)]
+        # no select() on serial handles, poll them
+        ready = []
+        for p in list(self._ports.values()):
+            try:
+                if p.in_waiting: ready.append(p)
+            except Exception:
+                self._drop(p)
+        if not ready: time.sleep(min(timeout,0.01))
+        return ready
+
+    def _run(self):
+        while self._runEn:
+            now = time.time()
+            if now >= self._nextScan:
+                self.scan()
+                self._nextScan = now + self._scanPeriod
+            if not self._ports:
+                time.sleep(0.1)
+                continue
+            for p in self._ready(0.1):
+                self._read(p)
+            for p in list(self._ports.values()):
+                # silent or not a ventilator, it gets another try next scan
+                if p.id is None and now - p.opened > self._probeTime:
+                    self._drop(p)
+                # a stalled unit is reopened at the next scan
+                elif p.ambu is not None and p.ambu._watchdog(now):
+                    self._drop(p)
+                    self._nextScan = min(self._nextScan, now + p.ambu._backoff)
+
+    def _read(self, p):
+        try:
+            frames = p.read()
+        except Exception:
+            self._drop(p)
+            return
+        if not frames:
+            return
+        if p.ambu is None:
+            for m in self._decoder.messages(frames):
+                if m.id == m.CPU_ID and m.nInt == 4:
+                    self._attach(p, tuple(m.intData))
+                    break
+            if p.ambu is None:
+                return
+        p.ambu._handlePackets(frames)
+
+    def _attach(self, p, cpuid):
+        for other in list(self._ports.values()):
+            # the same unit on a stale port
+            if other is not p and other.id == cpuid: self._drop(other)
+        p.id = cpuid
+        ambu = self.devices.get(cpuid)
+        new = ambu is None
+        if new:
+            ambu = AmbuControl(p)
+            self.devices[cpuid] = ambu
+        else:
+            ambu._ser = p
+        p.ambu = ambu
+        ambu.requestConfig()
+        if new and self._deviceCallBack is not None:
+            self._deviceCallBack(cpuid, ambu)
+
+
+if __name__ == '__main__':
+    # Prints the state of every unit found, once a second
+    mgr = DeviceManager(sys.argv[1:] or None)
+    mgr.start()
+    try:
+        while True:
+            time.sleep(1)
+            ports = mgr.ports()
+            for cpuid, ambu in list(mgr.devices.items()):
+                last = ambu._last or (0,0,0,0,0)
+                print(f"{'-'.join(f'{i:08x}' for i in cpuid)} {ports.get(cpuid,'disconnected'):16s} "
+                      f"count {last[0]:6d} samples {ambu._data.get_i():8d} state {ambu.runState}")
+            print()
+    except KeyboardInterrupt:
+        pass
+    mgr.stop()
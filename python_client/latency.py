@@ -0,0 +1,58 @@
+import numpy
+
+# Latency of the data path, from the serial read of a sample to the frame
+# that shows it. Times are host time.time() seconds.
+
+# Stages in path order. Every stage is measured from the serial read except
+# device, which is the age of a sample when it is read, against the host
+# time the device clock fit gives it (see device_clock.DeviceClock).
+STAGES = ('device', 'decode', 'commit', 'queue', 'display', 'render')
+
+
+class LatencyStats:
+    # Rolling window of the last size latencies of one stage. Each stage is
+    # written by one thread, readers may see a value being replaced, which
+    # is harmless for a percentile.
+    def __init__(self, size=2048):
+        self._v = numpy.zeros(size)
+        self._i = 0
+
+    def add(self, value):
+        self._v[self._i % len(self._v)] = value
+        self._i += 1
+
+    def addMany(self, values):
+        n = len(values)
+        if n == 0:
+            return
+        if n > len(self._v):
+            values = values[-len(self._v):]
+            self._i += n - len(values)
+            n = len(values)
+        idx = (self._i + numpy.arange(n)) % len(self._v)
+        self._v[idx] = values
+        self._i += n
+
+    def clear(self):
+        self._i = 0
+
+    def stats(self):
+        # p50, p99 and max in seconds, None before the first value
+        n = min(self._i, len(self._v))
+        if n == 0:
+            return None
+        v = self._v[:n]
+        p50, p99 = numpy.percentile(v, (50, 99))
+        return { 'n' : self._i, 'p50' : float(p50), 'p99' : float(p99), 'max' : float(v.max()) }
+
+
+class Latency:
+    # One LatencyStats per stage
+    def __init__(self, size=2048):
+        self.stages = { s : LatencyStats(size) for s in STAGES }
+
+    def add(self, stage, value):
+        self.stages[stage].add(value)
+
+    def stats(self):
+        return { s : l.stats() for s, l in self.stages.items() }
@@ -1,23 +1,116 @@
 import base64
+import binascii
 import struct
+import itertools
+import numpy
+
+# Bytes summed between modulo reductions in fletcher16. Any block length
+# gives the same result, this just keeps the partial sums small.
+FLETCHER_BLOCK = 4096
+
+def fletcher16(data):
+    # Fletcher-16 over bytes, reduced once per block instead of per byte.
+    # sum2 gains len(block)*sum1 for the carried sum plus the block's own
+    # running sums.
+    sum1=0
+    sum2=0
+    for i in range(0,len(data),FLETCHER_BLOCK):
+        block=data[i:i+FLETCHER_BLOCK]
+        sum2=(sum2+len(block)*sum1+sum(itertools.accumulate(block))) % 255
+        sum1=(sum1+sum(block)) % 255
+    return (sum2 << 8) | sum1
+
+def fletcher16Array(frames):
+    # Fletcher-16 of every row of a (k, n) uint8 array of equal length packets
+    frames=numpy.asarray(frames,dtype=numpy.uint8)
+    n=frames.shape[1]
+    weights=numpy.arange(n,0,-1,dtype=numpy.int64)
+    sum1=frames.sum(axis=1,dtype=numpy.int64) % 255
+    sum2=frames.astype(numpy.int64).dot(weights) % 255
+    return ((sum2 << 8) | sum1).astype(numpy.uint16)
+
+def verifyArray(frames):
+    # frames is (k, n) uint8 with the little endian checksum in the last two
+    # bytes of each row, returns a bool per row
+    frames=numpy.asarray(frames,dtype=numpy.uint8)
+    sent=frames[:,-2].astype(numpy.uint16) | (frames[:,-1].astype(numpy.uint16) << 8)
+    return fletcher16Array(frames[:,:-2]) == sent
+
+
+# Layout of a DATA packet carrying 5 floats and 2 ints, as sent by the
+# ventilator firmware. Packed little endian, 36 bytes, 48 base64 characters.
+DATA_LEN=0x25
+DATA_DTYPE=numpy.dtype([('id','u1'),('millis','<u4'),('len','u1'),
+                        ('volMax','<f4'),('pipMax','<f4'),('press','<f4'),('flow','<f4'),('vol','<f4'),
+                        ('count','<u4'),('status','<u4'),('checksum','<u2')])
+DATA_FRAME_SIZE=48
+
+def decodeDataArray(frames):
+    # Decodes a list of DATA_FRAME_SIZE base64 frames in one pass. Returns
+    # the records as a DATA_DTYPE array and a bool per frame that is true
+    # where the header, length and checksum are all good.
+    if len(frames)==0:
+        return numpy.zeros(0,DATA_DTYPE),numpy.zeros(0,dtype=bool)
+    try:
+        dec=base64.b64decode(b''.join(frames),validate=True)
+    except binascii.Error:
+        # a bad character somewhere, decode each frame on its own
+        dec=b''.join(_decodeFrame(f) for f in frames)
+    raw=numpy.frombuffer(dec,dtype=numpy.uint8).reshape(-1,DATA_DTYPE.itemsize)
+    rec=raw.view(DATA_DTYPE).reshape(-1)
+    ok=(rec['id']==Message.DATA) & (rec['len']==DATA_LEN) & verifyArray(raw)
+    return rec,ok
+
+def _decodeFrame(frame):
+    try:
+        dec=base64.b64decode(frame,validate=True)
+    except binascii.Error:
+        dec=b''
+    if len(dec)!=DATA_DTYPE.itemsize:
+        dec=bytes(DATA_DTYPE.itemsize)
+    return dec
+
+# struct.Struct codecs, built on first use and cached by the length byte
+_decodeData={}
+_decodeString={}
+_encodeData={}
+_encodeString={}
+_checksum=struct.Struct("<H")
+
+def _dataCodec(cache,l,trailer):
+    c=cache.get(l)
+    if c is None:
+        c=struct.Struct("<BIB"+str(l&0xf)+"f"+str(l>>4)+"I"+trailer)
+        cache[l]=c
+    return c
+
+def _stringCodec(cache,l,trailer):
+    c=cache.get(l)
+    if c is None:
+        c=struct.Struct("<BIB"+str(l)+"s"+trailer)
+        cache[l]=c
+    return c
 
 
 class Message():
-    def __init__(self):
-        self.DATA  = 0xc1
-        self.CONFIG  = 0xc2
-        self.PARAM_INTEGER  = 0xc3
-        self.PARAM_FLOAT  = 0xc4
-        self.PARAM_SET  = 0xc5
-        self.CPU_ID  = 0xc6 
-        self.VERSION  = 0xc8
-        self.DEBUG   = 0xc9
-
-        self.ERR_OK=0x0;
-        self.ERR_LENGTH=0xe1;
-        self.ERR_HEADER=0xe2;
-        self.ERR_CHECKSUM=0xe3;
+    DATA  = 0xc1
+    CONFIG  = 0xc2
+    PARAM_INTEGER  = 0xc3
+    PARAM_FLOAT  = 0xc4
+    PARAM_SET  = 0xc5
+    CPU_ID  = 0xc6
+    VERSION  = 0xc8
+    DEBUG   = 0xc9
+
+    ERR_OK=0x0
+    ERR_LENGTH=0xe1
+    ERR_HEADER=0xe2
+    ERR_CHECKSUM=0xe3
+
+    __slots__=('id','checksum','data','nFloat','nInt','floatData','intData',
+               'status','string','millis')
 
+    def __init__(self):
         self.id=0
         self.checksum=0
         self.data=None
@@ -31,76 +124,51 @@ class Message():
 
     def decode(self,msg):
         dec=base64.b64decode(msg)
-        if(len(dec)<7): 
+        if(len(dec)<7):
             self.status=self.ERR_LENGTH
             return
-        header=struct.unpack("<BIB",dec[:6])
-        l=header[-1]
-        self.id=header[0]
-        self.millis=header[1]
-        data=None
+        self.id=dec[0]
+        l=dec[5]
         if((self.id&0xc0)!=0xc0):
             self.status=self.ERR_HEADER
             return
         if((self.id&8)==0):
-            int_len=(l>>4);
-            float_len=(l&0xf);
-            data=struct.unpack("<"+str(float_len)+"f"+str(int_len)+  "IH",dec[6:])
-            checksum_sent=data[-1]        
-            checksum=self._fletcher16(dec[:-2])
-            if(checksum_sent!=checksum):
-                status=self.ERR_CHECKSUM
-                return
+            codec=_dataCodec(_decodeData,l,"H")
+        else:
+            codec=_stringCodec(_decodeString,l,"H")
+        if(len(dec)!=codec.size):
+            self.status=self.ERR_LENGTH
+            return
+        data=codec.unpack(dec)
+        self.millis=data[1]
+        self.checksum=data[-1]
+        if(self.checksum!=fletcher16(dec[:-2])):
+            self.status=self.ERR_CHECKSUM
+            return
+        if((self.id&8)==0):
+            float_len=(l&0xf)
             self.nFloat=float_len
-            self.nInt=int_len
-            self.floatData=data[:float_len]
-            self.intData=data[float_len:float_len+int_len]
-        else:            
-            data=struct.unpack("<"+str(l)+"sH",dec[6:])       
-            checksum_sent=data[-1]        
-            checksum=self._fletcher16(dec[:-2])
-            if(checksum_sent!=checksum):
-                status=self.ERR_CHECKSUM
-                return
-            self.string=data[0]
-        
+            self.nInt=(l>>4)
+            self.floatData=data[3:3+float_len]
+            self.intData=data[3+float_len:-1]
+        else:
+            self.string=data[3]
+
     def writeData(self,id,timestamp,float_data,int_data):
-        float_len=len(float_data)
-        int_len=len(int_data)
-        l=float_len+int_len*16
-        fmt="<BIB"+str(float_len)+"f"+str(int_len)+"I"
-        data=struct.pack(fmt,
-                    id,
-                    timestamp,
-                    l,
-                    *float_data,
-                    *int_data                    
-                )
-        checksum=self._fletcher16(data)
-        data=data+struct.pack("H",checksum)
+        l=len(float_data)+len(int_data)*16
+        data=_dataCodec(_encodeData,l,"").pack(id,timestamp,l,*float_data,*int_data)
+        data=data+_checksum.pack(fletcher16(data))
         en=base64.b64encode(data)
         en=en+b'-'
         return en
+
     def writeString(self,id,timestamp,s):
         l=len(s)
-        fmt="<BIB"+str(l)+"s"
-        data=struct.pack(fmt,
-                    id,
-                    timestamp,
-                    l,
-                    s
-                )
-        checksum=self._fletcher16(data)
-        data=data+struct.pack("H",checksum)
+        data=_stringCodec(_encodeString,l,"").pack(id,timestamp,l,s)
+        data=data+_checksum.pack(fletcher16(data))
         en=base64.b64encode(data)
         en=en+b'-'
         return en
 
     def _fletcher16(self,data):
-        sum1=0
-        sum2=0
-        for i in range(len(data)):
-            sum1=((sum1+data[i]) & 0xffff) % 255
-            sum2=((sum2+sum1) & 0xffff) % 255
-        result=((sum2 << 8) | sum1) & 0xffff
-        return result
+        return fletcher16(data)
@@ -1,25 +1,62 @@
 import numpy
 
 class npfifo:
-    def __init__(self, num_parm, num_points):
+    def __init__(self, num_parm, num_points, guard=0):
         self._n = num_parm
         self._x = num_points
-        self.A = numpy.zeros((self._n, self._x))
+        # Samples kept beyond the window so published snapshots stay intact
+        # until guard more samples have been written
+        self._g = guard
+        self._c = num_points + guard
+        # Ring buffer with every sample written twice, one capacity apart, so
+        # the latest num_points samples are always one contiguous slice
+        self._B = numpy.zeros((self._n, 2*self._c))
+        self._w = 0
         self._i = 0
 
+    @property
+    def A(self):
+        # Time ordered view of the whole window, oldest sample first
+        return self._B[:,self._w+self._c-self._x:self._w+self._c]
+
     def append(self, X):
         if len(X) != self._n:
             #print("Wrong number of parameters to append, ignoring")
             return
-        # Move the data in the buffer
-        self.A[:,:-1] = self.A[:,1:]
-        # add the data to the end of the buffer
-        self.A[:,-1] = X
+        # add the data at the write index and its mirror
+        self._B[:,self._w] = X
+        self._B[:,self._w+self._c] = X
+        # advance write index with wraparound
+        self._w += 1
+        if self._w == self._c:
+            self._w = 0
         # increment number of data-points entered
         self._i += 1
 
+    def append_many(self, X):
+        # X is a (num_parm, k) block, oldest sample in the first column
+        X = numpy.asarray(X)
+        if X.ndim != 2 or X.shape[0] != self._n:
+            return
+        k = X.shape[1]
+        if k == 0:
+            return
+        # only the newest samples that fit in the ring can survive the write
+        m = min(k, self._c)
+        s = (self._w + k - m) % self._c
+        first = min(m, self._c - s)
+        self._B[:,s:s+first] = X[:,k-m:k-m+first]
+        self._B[:,s+self._c:s+self._c+first] = X[:,k-m:k-m+first]
+        rest = m - first
+        if rest > 0:
+            self._B[:,:rest] = X[:,k-rest:]
+            self._B[:,self._c:self._c+rest] = X[:,k-rest:]
+        self._w = (self._w + k) % self._c
+        self._i += k
+
     def clear(self):
-        self.A = 0.0
+        self._B[:,:] = 0.0
+        self._w = 0
         self._i = 0
 
     def get_data(self):
@@ -35,5 +72,43 @@ class npfifo:
     def get_n(self):
         return min(self._i, self._x)
 
+    def get_last_time(self):
+        return self._B[0, self._w+self._c-1]
+
     def get_nextout_time(self):
         return self.A[0, -(self.get_n()-1)]
+
+    def snapshot(self):
+        return npsnapshot(self)
+
+
+class npsnapshot:
+    # Read-only view of an npfifo window. No data is copied, the view stays
+    # consistent until the fifo has taken more than guard further samples.
+    def __init__(self, fifo):
+        self._fifo = fifo
+        self.seq = fifo.get_i()
+        self._n = fifo.get_n()
+        self.A = fifo.A
+        self.A.flags.writeable = False
+
+    def valid(self):
+        return (self._fifo.get_i() - self.seq) <= self._fifo._g
+
+    def get_data(self):
+        if self.seq > 1:
+            return self.A[:,-self._n:]
+        else:
+            return None
+
+    def get_i(self):
+        return self.seq
+
+    def get_n(self):
+        return self._n
+
+    def get_last_time(self):
+        return self.A[0,-1]
+
+    def get_nextout_time(self):
+        return self.A[0, -(self._n-1)]
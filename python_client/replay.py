@@ -0,0 +1,165 @@
+import base64
+import binascii
+import collections
+import struct
+import threading
+import time
+import message
+import stream
+import session_log
+import device_config
+
+_stamp = struct.Struct("<BI")
+
+
+class ReplayComm:
+    # Stands in for comm.Comm and plays back a recorded session. The source is
+    # either a raw capture (the bytes read from the port, see Comm.setCapture)
+    # or a binary session log. Frames are paced by their millis stamps:
+    # speed=1 is real time, speed=N is N times faster and speed=0 is as fast
+    # as possible. Commands written to it are answered the way the firmware
+    # would, with a new CONFIG packet.
+
+    def __init__(self, fName, speed=1.0, loop=False, handshake=True, burst=64, timeout=1.0):
+        self.fName = fName
+        self._speed = speed
+        self._loop = loop
+        self._handshake = handshake
+        self._burst = burst
+        self._timeout = timeout
+        self._frames = None
+        self._next = None
+        self._pending = collections.deque()
+        self._packets = collections.deque()
+        self._decoder = stream.Decoder()
+        self._device = None
+        self._lock = threading.Lock()
+        self.port = fName
+        self.id = None
+        self.connects = 0
+        self.sent = 0
+
+    def connect(self):
+        self.connects = self.connects + 1
+        with open(self.fName,'rb') as f:
+            isLog = f.read(len(session_log.MAGIC)) == session_log.MAGIC
+        if isLog:
+            header, _ = session_log.readLog(self.fName)
+            self._device = device_config.DeviceConfig(header['cpuid'], header['version'],
+                                                      list(header['config'].values()),
+                                                      header['runState'], max(header['cfgSerial'],1))
+        else:
+            self._device = device_config.DeviceConfig()
+        self.id = self._device.cpuid
+        self._isLog = isLog
+        self._frames = self._source()
+        self._next = None
+        self._t0 = None
+        self._lastMillis = None
+        self._lastDue = time.time()
+        if self._handshake:
+            self._pending.extend(f[:-1] for f in self._device.frames(0))
+
+    def _connected(self):
+        # readPackets and write can race to the first connect
+        with self._lock:
+            if self._frames is None: self.connect()
+
+    def _source(self):
+        # Yields (millis, frame) with the '-' delimiter removed
+        if self._isLog:
+            yield from self._logFrames()
+        else:
+            framer = stream.Framer()
+            with open(self.fName,'rb') as f:
+                for chunk in stream.readChunks(f):
+                    for frame in framer.frames(chunk):
+                        yield self._millis(frame), frame
+
+    def _logFrames(self):
+        _, rec = session_log.readLog(self.fName)
+        m = message.Message()
+        nextConfig = None
+        # the log does not keep the per breath maxima, rebuild them the way
+        # the firmware does: the maximum over the previous breath
+        count = None
+        volMax = pipMax = currVol = currPip = 0.0
+        for i in range(len(rec)):
+            r = rec[i]
+            millis = int(r['millis'])
+            # the firmware sends its config once a second
+            if nextConfig is None or millis >= nextConfig or millis < nextConfig - 2000:
+                for f in self._device.frames(millis):
+                    yield millis, f[:-1]
+                nextConfig = millis + 1000
+            if r['count'] != count:
+                count = r['count']
+                volMax, pipMax = currVol, currPip
+                currVol = currPip = 0.0
+            currVol = max(currVol, float(r['vol']))
+            currPip = max(currPip, float(r['press']))
+            frame = m.writeData(m.DATA, millis, [volMax, pipMax, r['press'], r['flow'], r['vol']],
+                                [int(r['count']), int(r['status'])])
+            yield millis, frame[:-1]
+
+    def _millis(self, frame):
+        try:
+            return _stamp.unpack_from(base64.b64decode(frame[:8]))[1]
+        except (binascii.Error, struct.error):
+            return None
+
+    def _due(self, millis):
+        if self._speed == 0 or millis is None:
+            return self._lastDue
+        if self._t0 is None or millis < self._lastMillis:
+            # first frame, or the recorded device was reset
+            self._t0 = self._lastDue
+            self._m0 = millis
+        self._lastMillis = millis
+        self._lastDue = self._t0 + (millis - self._m0) / 1000. / self._speed
+        return self._lastDue
+
+    def readPackets(self):
+        self._connected()
+        out = []
+        while self._pending and len(out) < self._burst:
+            out.append(self._pending.popleft())
+        while len(out) < self._burst:
+            if self._next is None:
+                nxt = next(self._frames, None)
+                if nxt is None:
+                    if not self._loop:
+                        # end of the recording looks like a silent device
+                        if not out: time.sleep(self._timeout)
+                        break
+                    self._frames = self._source()
+                    self._t0 = None
+                    continue
+                self._next = (self._due(nxt[0]), nxt[1])
+            wait = self._next[0] - time.time()
+            if wait > 0:
+                if out: break
+                if wait > self._timeout:
+                    # behave like a serial read timeout
+                    time.sleep(self._timeout)
+                    break
+                time.sleep(wait)
+            out.append(self._next[1])
+            self._next = None
+        self.sent += len(out)
+        return out
+
+    def readPacket(self):
+        if not self._packets:
+            self._packets.extend(self.readPackets())
+        if self._packets:
+            return self._packets.popleft()
+        return None
+
+    def write(self, data):
+        self._connected()
+        for m in self._decoder.feed(data):
+            if self._device.command(m):
+                millis = self._lastMillis if self._lastMillis is not None else 0
+                # the firmware answers with CONFIG, VERSION and CPU_ID
+                self._pending.extend(f[:-1] for f in self._device.frames(millis))
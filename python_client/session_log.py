@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import struct
+import time
+import queue
+import threading
+import numpy
+
+# Binary session log: a fixed size little endian header followed by fixed
+# size sample records, so a file can be appended to in blocks and mapped
+# straight into numpy with readLog(). Events such as data gaps go to a JSON
+# lines sidecar next to it, see readEvents().
+
+MAGIC = b'PABVLOG\0'
+FORMAT = 1
+HEADER_SIZE = 256
+
+# magic, format, header size, record size, start time, cpu id, firmware
+# version, config floats (same order as the CONFIG packet), run state and
+# config serial number
+_header = struct.Struct("<8sHHHxxd4I64s8f2I")
+
+EVENTS_SUFFIX = '.events'
+
+RECORD_DTYPE = numpy.dtype([('ts','<f8'),('millis','<u4'),('status','<u4'),('count','<u4'),
+                            ('press','<f4'),('flow','<f4'),('vol','<f4')])
+
+CONFIG_NAMES = ('respRate','inhTime','pipMax','pipOffset','volMax','volFactor','volInThold','peepMin')
+
+
+class SessionLog:
+    # Appends to an existing log of the same unit and firmware, after
+    # cutting off a partial last record. A log of another unit or firmware,
+    # or a file that is no session log, is left alone and the session goes
+    # to the first free or matching name root-NNN.ext instead, fName is the
+    # file actually written.
+    def __init__(self, fName, cpuid=(0,0,0,0), version='unknown', config=(0,)*8, runState=0, cfgSerial=0):
+        if isinstance(version,str): version = version.encode()
+        version = version[:64]
+        self.fName = fName = _sessionName(fName, tuple(cpuid), version.rstrip(b'\0').decode(errors='replace'))
+        exists = os.path.exists(fName) and os.path.getsize(fName) > 0
+        if exists:
+            size = os.path.getsize(fName)
+            end = size - (size - HEADER_SIZE) % RECORD_DTYPE.itemsize
+            if end < size: os.truncate(fName, end)
+        self._f = open(fName,'ab')
+        if not exists:
+            h = _header.pack(MAGIC, FORMAT, HEADER_SIZE, RECORD_DTYPE.itemsize, time.time(),
+                             *cpuid, version, *config, runState, cfgSerial)
+            self._f.write(h.ljust(HEADER_SIZE,b'\0'))
+
+    def write(self, rec):
+        # rec is a RECORD_DTYPE array
+        self._f.write(rec.tobytes())
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def tell(self):
+        return self._f.tell()
+
+
+class LogWriter:
+    # Writes a session log from its own thread. write() never blocks: blocks
+    # of records go through a bounded queue and are dropped, and counted,
+    # when the queue is full. Batches are flushed every flushPeriod seconds,
+    # and a new file is started after maxBytes or maxSeconds when set.
+    # header is a callable returning the SessionLog keyword arguments, it is
+    # called each time a file is opened. When a file cannot be opened the
+    # writer stops, error holds why and every later block counts as dropped.
+    def __init__(self, fName, header=dict, maxQueue=256, flushPeriod=1.0, maxBytes=0, maxSeconds=0):
+        self.fName = fName
+        self._header = header
+        self._queue = queue.Queue(maxQueue)
+        self._flushPeriod = flushPeriod
+        self._maxBytes = maxBytes
+        self._maxSeconds = maxSeconds
+        self._events = queue.SimpleQueue()
+        self._runEn = True
+        self.drops = 0
+        self.written = 0
+        self.files = []
+        self.error = None
+        # not a daemon, what is queued is written out even when the program
+        # exits without closing the log, see _run
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    def write(self, rec):
+        if not self._runEn:
+            if self.error is not None: self.drops += len(rec)
+            return
+        try:
+            self._queue.put_nowait(rec)
+        except queue.Full:
+            self.drops += len(rec)
+
+    def event(self, kind, **fields):
+        # Queues an event for the sidecar of the current log file
+        if not self._runEn: return
+        self._events.put(dict(fields, event=kind, ts=fields.get('ts',time.time())))
+
+    def close(self):
+        # Returns at once, the thread writes out what is queued and exits
+        self._runEn = False
+        try:
+            self._queue.put_nowait(None)   # wakes the thread
+        except queue.Full:
+            pass
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    @property
+    def alive(self):
+        return self._thread.is_alive()
+
+    def _open(self):
+        # The first file may append to an earlier session, see SessionLog,
+        # later ones go to the next free name
+        root, ext = os.path.splitext(self.fName)
+        name, i = self.fName, 0
+        while self.files and (name in self.files or os.path.exists(name)):
+            i += 1
+            name = f"{root}-{i:03d}{ext}"
+        log = SessionLog(name, **self._header())
+        self.files.append(log.fName)
+        return log, time.time()
+
+    def _writeEvents(self, log):
+        lines = []
+        while not self._events.empty():
+            lines.append(json.dumps(self._events.get())+'\n')
+        if not lines: return
+        try:
+            with open(log.fName+EVENTS_SUFFIX,'a') as f:
+                f.writelines(lines)
+        except Exception as e:
+            self.error = e
+
+    def _fail(self, e):
+        # stops the writer, what is queued is dropped
+        self.error = e
+        self._runEn = False
+        while not self._queue.empty():
+            rec = self._queue.get()
+            if rec is not None: self.drops += len(rec)
+
+    def _run(self):
+        try:
+            log, opened = self._open()
+        except Exception as e:
+            self._fail(e)
+            return
+        batch = []
+        flushed = time.time()
+        while True:
+            try:
+                rec = self._queue.get(timeout=self._flushPeriod)
+                if rec is not None: batch.append(rec)
+                more = True
+            except queue.Empty:
+                more = False
+            # the main thread has ended when the program exits with the log open
+            stop = not self._runEn or not threading.main_thread().is_alive()
+            done = stop and self._queue.empty()
+            now = time.time()
+            if batch and (done or not more or now - flushed >= self._flushPeriod):
+                rec = numpy.concatenate(batch)
+                batch = []
+                try:
+                    log.write(rec)
+                    log.flush()
+                    self.written += len(rec)
+                except Exception as e:
+                    self.error = e
+                    self.drops += len(rec)
+                flushed = now
+                if ((self._maxBytes and log.tell() >= self._maxBytes) or
+                    (self._maxSeconds and now - opened >= self._maxSeconds)):
+                    log.close()
+                    try:
+                        log, opened = self._open()
+                    except Exception as e:
+                        self._fail(e)
+                        return
+            self._writeEvents(log)
+            if done:
+                break
+        log.close()
+
+
+def _sessionName(fName, cpuid, version):
+    # fName or the first root-NNN.ext after it that is free or a log of this
+    # unit and firmware
+    root, ext = os.path.splitext(fName)
+    name, i = fName, 0
+    while os.path.exists(name) and os.path.getsize(name) > 0:
+        try:
+            h = readHeader(name)
+        except (OSError, ValueError):
+            h = None   # not a log, or not one that can be appended to
+        if h is not None and tuple(h['cpuid']) == cpuid and h['version'] == version:
+            break
+        i += 1
+        name = f"{root}-{i:03d}{ext}"
+    return name
+
+
+def readHeader(fName):
+    with open(fName,'rb') as f:
+        data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE or data[:8] != MAGIC:
+        raise ValueError(f"{fName} is not a session log")
+    h = _header.unpack_from(data)
+    if h[1] != FORMAT or h[3] != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{fName} has unsupported log format {h[1]}")
+    return { 'start'     : h[4],
+             'cpuid'     : h[5:9],
+             'version'   : h[9].rstrip(b'\0').decode(errors='replace'),
+             'config'    : dict(zip(CONFIG_NAMES,h[10:18])),
+             'runState'  : h[18],
+             'cfgSerial' : h[19] }
+
+
+def readLog(fName):
+    # Returns the header and a read only memmap of every complete record
+    header = readHeader(fName)
+    n = (os.path.getsize(fName) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if n == 0:
+        return header, numpy.zeros(0,RECORD_DTYPE)
+    return header, numpy.memmap(fName, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(n,))
+
+
+def readEvents(fName):
+    # Events recorded with a log, as a list of dicts
+    try:
+        with open(fName+EVENTS_SUFFIX) as f:
+            return [json.loads(l) for l in f if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+if __name__ == '__main__':
+    # Dump a log in the old text format: ts, status, count, press, flow, vol
+    header, rec = readLog(sys.argv[1])
+    print(f"# {header}")
+    for e in readEvents(sys.argv[1]):
+        print(f"# {e}")
+    for r in rec:
+        print(f"{r['ts']}, {r['status']}, {r['count']}, {r['press']}, {r['flow']}, {r['vol']}")
@@ -0,0 +1,219 @@
+import os
+import math
+import time
+import tty
+import fcntl
+import select
+import argparse
+import threading
+import message
+import stream
+import device_config
+from ambu_control import AmbuControl
+
+
+class Simulator:
+    # Host side ventilator on a pseudo terminal. Speaks the ambu_common
+    # protocol: DATA packets at the chosen rate, CONFIG/VERSION/CPU_ID once a
+    # second, and PARAM_FLOAT/PARAM_INTEGER/PARAM_SET commands handled like
+    # the firmware AmbuConfig. Open self.port with comm.Comm(port=...).
+
+    Shapes = ('square', 'sine', 'ramp')
+
+    def __init__(self, rate=100.0, shape='square', pip=30.0, peep=5.0, compliance=20.0,
+                 cpuid=(0x53494d55,0,0,1), version=b'simulator', startMillis=0, resetPeriod=0):
+        if shape not in self.Shapes:
+            raise ValueError(f"Unknown breath shape {shape}")
+        self.rate = rate
+        self.shape = shape
+        self.pip = pip
+        self.peep = peep
+        self.compliance = compliance   # mL per cmH2O
+        self.startMillis = startMillis
+        self.resetPeriod = resetPeriod
+        self.config = device_config.DeviceConfig(cpuid, version)
+        self.sent = 0
+        self.resets = 0
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        # nobody reading the port must not stall the simulator
+        flags = fcntl.fcntl(self._master, fcntl.F_GETFL)
+        fcntl.fcntl(self._master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.port = os.ttyname(self._slave)
+
+        self._decoder = stream.Decoder()
+        self._alarms = []
+        self._stallUntil = 0
+        self._lock = threading.Lock()
+        self._runEn = False
+        self._thread = None
+        self._boot(time.time(), self.startMillis)
+
+    def start(self):
+        self._runEn = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self):
+        self._runEn = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def injectAlarm(self, bits, duration=None):
+        # Sets status bits, e.g. AmbuControl.StatusKey['AlarmPipMax'], until
+        # duration seconds have passed or the alarm is muted
+        until = None if duration is None else time.time() + duration
+        with self._lock:
+            self._alarms.append((bits, until))
+
+    def stall(self, duration):
+        # The device keeps running but nothing reaches the port for duration
+        # seconds, like a USB hiccup
+        self._stallUntil = time.time() + duration
+
+    def reset(self):
+        # Restart as the board does after a reset: millis, breath count and
+        # config serial number start over
+        with self._lock:
+            self._boot(time.time(), 0)
+            self._send([message.Message().writeString(message.Message.DEBUG, 0, b"Booted")])
+            self.resets += 1
+
+    def _boot(self, now, millis):
+        # millis is where the millis counter starts
+        self._t0 = now
+        self._millis0 = millis
+        self._count = 0
+        self._breath = 0.0
+        self._volMax = self._pipMax = 0.0
+        self._currVol = self._currPip = 0.0
+        self._nextConfig = 0
+        self._samples = 0
+        self._vol = 0.0
+        self.config.serial = 1
+
+    def _send(self, frames):
+        if time.time() < self._stallUntil:
+            return
+        try:
+            os.write(self._master, b''.join(frames))
+            self.sent += len(frames)
+        except (BlockingIOError, OSError):
+            pass
+
+    def _commands(self):
+        if not select.select([self._master],[],[],0)[0]:
+            return
+        try:
+            data = os.read(self._master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        for m in self._decoder.feed(data):
+            if self.config.command(m):
+                if self.config.muted:
+                    self.config.muted = False
+                    self._alarms = []
+                self._nextConfig = 0
+
+    def _status(self, now, inhale):
+        status = 0
+        self._alarms = [a for a in self._alarms if a[1] is None or a[1] > now]
+        for bits, until in self._alarms:
+            status |= bits
+        # upper 8 bits carry the cycle state, StateOn or StateOff
+        return status | ((1 if inhale else 0) << 24)
+
+    def _pressure(self, phase, ti, pip):
+        # pressure at phase seconds into the breath
+        if phase >= ti:
+            # passive exhale towards peep
+            top = self.peep if self.shape == 'sine' else self._pressure(ti - 1e-6, ti, pip)
+            return self.peep + (top - self.peep) * math.exp(-(phase - ti) / 0.2)
+        if self.shape == 'square':
+            return self.peep + (pip - self.peep) * (1 - math.exp(-phase / 0.1))
+        if self.shape == 'sine':
+            return self.peep + (pip - self.peep) * math.sin(math.pi * phase / ti)
+        return self.peep + (pip - self.peep) * phase / ti
+
+    def _sample(self, t):
+        respRate, inhTime = self.config.config[0], self.config.config[1]
+        period = 60.0 / respRate if respRate > 0 else 1e9
+        ti = min(inhTime, period)
+        if t - self._breath >= period:
+            # start of a new breath, as CycleControl does it
+            self._breath += period * math.floor((t - self._breath) / period)
+            self._count += 1
+            self._volMax, self._pipMax = self._currVol, self._currPip
+            self._currVol = self._currPip = 0.0
+        phase = t - self._breath
+        # the relief valve caps the pressure at pipMax + pipOffset
+        pip = min(self.pip, self.config.config[2] + self.config.config[3])
+        state = AmbuControl.RunStates.get(self.config.runState)
+        if state == 'StateRunOn':
+            inhale = phase < ti
+            press = self._pressure(phase, ti, pip)
+        else:
+            inhale = state == 'StateForceOn'
+            press = pip if inhale else self.peep
+        vol = self.compliance * (press - self.peep)
+        dt = 1.0 / self.rate
+        flow = (vol - self._vol) / dt * 60.0 / 1000.0
+        self._vol = vol
+        self._currVol = max(self._currVol, vol)
+        self._currPip = max(self._currPip, press)
+        return press, flow, vol, inhale
+
+    def _run(self):
+        m = message.Message()
+        while self._runEn:
+            now = time.time()
+            self._commands()
+            with self._lock:
+                if self.resetPeriod and now - self._t0 >= self.resetPeriod:
+                    self._boot(now, 0)
+                    self.resets += 1
+                frames = []
+                due = int((now - self._t0) * self.rate)
+                while self._samples < due:
+                    self._samples += 1
+                    t = self._samples / self.rate
+                    millis = int(self._millis0 + t * 1000) & 0xffffffff
+                    if t * 1000 >= self._nextConfig:
+                        frames.extend(self.config.frames(millis))
+                        self._nextConfig = t * 1000 + 1000
+                    press, flow, vol, inhale = self._sample(t)
+                    frames.append(m.writeData(m.DATA, millis,
+                                              [self._volMax, self._pipMax, press, flow, vol],
+                                              [self._count, self._status(now, inhale)]))
+                if frames:
+                    self._send(frames)
+            time.sleep(max(0.0, (self._samples + 1) / self.rate - (time.time() - self._t0)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated ventilator on a pseudo terminal')
+    parser.add_argument('--rate', type=float, default=100.0, help='DATA packets per second')
+    parser.add_argument('--shape', default='square', choices=Simulator.Shapes, help='breath pressure waveform')
+    parser.add_argument('--pip', type=float, default=30.0, help='peak pressure, cmH2O')
+    parser.add_argument('--peep', type=float, default=5.0, help='end expiratory pressure, cmH2O')
+    parser.add_argument('--start-millis', type=int, default=0, help='initial millis, e.g. 4294960000 to test rollover')
+    parser.add_argument('--reset-period', type=float, default=0, help='reset the device every N seconds')
+    args = parser.parse_args()
+
+    sim = Simulator(rate=args.rate, shape=args.shape, pip=args.pip, peep=args.peep,
+                    startMillis=args.start_millis, resetPeriod=args.reset_period)
+    print(f"Simulator on {sim.port}, run: python client.py --port {sim.port}")
+    sim.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.close()
@@ -0,0 +1,95 @@
+# Status fields shown by ControlGui, as display strings. The GUI publishes
+# only what changed since the last frame, see StatusModel.
+
+# Alarm levels of the alarmLevel field, in rising order
+LEVEL_CLEAR   = 0
+LEVEL_WARNING = 1
+LEVEL_ALARM   = 2
+
+LEVEL_TEXT = { LEVEL_CLEAR : 'Clear', LEVEL_WARNING : 'Warning', LEVEL_ALARM : 'Alarm' }
+
+
+def alarmLevel(ambu):
+    if ambu.alarmPipMax or ambu.alarmVolLow or ambu.alarm12V or ambu.alarmPresLow:
+        return LEVEL_ALARM
+    if ambu.warn9V or ambu.warnPeepMin:
+        return LEVEL_WARNING
+    return LEVEL_CLEAR
+
+
+def displayFields(ambu, count, rate, stime, artime, volMax, pipMax):
+    # fields that come with each data queue entry
+    return { 'count'        : str(count),
+             'rate'         : f"{rate:.1f}",
+             'stime'        : f"{stime:.1f}",
+             'artime'       : f"{artime:.1f}",
+             'volMax'       : f"{volMax:.1f}",
+             'pipMax'       : f"{pipMax:.1f}",
+             'alarmPipMax'  : str(ambu.alarmPipMax),
+             'alarmVolLow'  : str(ambu.alarmVolLow),
+             'alarm12V'     : str(ambu.alarm12V),
+             'warn9V'       : str(ambu.warn9V),
+             'alarmPresLow' : str(ambu.alarmPresLow),
+             'warnPeepMin'  : str(ambu.warnPeepMin),
+             'logBacklog'   : str(ambu.logBacklog),
+             'logDrops'     : str(ambu.logDrops),
+             'logError'     : str(ambu.logError or ''),
+             'alarmLevel'   : alarmLevel(ambu) }
+
+
+def streamFields(ambu):
+    # fields that change while no data arrives
+    stalled = ambu.stalled
+    gaps = ambu.gaps
+    fields = { 'stream'     : f"Stalled {stalled:.1f} s" if stalled else "OK",
+               'gaps'       : str(len(gaps)),
+               'reconnects' : str(ambu.reconnects) }
+    if gaps:
+        g = gaps[-1]
+        fields['lastGap'] = f"{g['duration']:.2f} s, {g['lostSamples']} samples" + (", reset" if g['reset'] else "")
+    return fields
+
+
+def timingFields(ambu):
+    # device clock fit and the latency of each stage, p50 / p99 / max in ms
+    fields = {}
+    clock = ambu.clock
+    if clock.ready:
+        fields['clock'] = f"skew {1e6*clock.skew:+.0f} ppm, drift {1e6*clock.drift:+.1f} ppm/h"
+    for stage, st in ambu.latency.stats().items():
+        if st is not None:
+            fields['latency.'+stage] = f"{1000*st['p50']:.1f} / {1000*st['p99']:.1f} / {1000*st['max']:.1f}"
+    return fields
+
+
+def breathFields(breaths):
+    # fields of the last breath, empty before the first one
+    last = breaths.last()
+    if last is None:
+        return {}
+    return { 'breathRate' : f"{last['rate']:.1f}",
+             'pip'        : f"{last['pip']:.1f}",
+             'peep'       : f"{last['peep']:.1f}",
+             'tidalVol'   : f"{last['vt']:.0f}",
+             'ieRatio'    : f"1:{1/last['ie']:.1f}" if last['ie'] > 0 else "",
+             'rateCv'     : f"{100*breaths.stats()['rate']['cv']:.1f}" }
+
+
+class StatusModel:
+    # Last published value of every field. update() takes the fields of a
+    # frame and returns the ones that differ, the only ones the widgets
+    # need to be told about.
+    def __init__(self):
+        self._last = {}
+
+    def clear(self):
+        # the next update returns every field
+        self._last = {}
+
+    def update(self, fields):
+        changed = { k : v for k, v in fields.items() if self._last.get(k) != v }
+        self._last.update(changed)
+        return changed
+
+    def get(self, name, default=None):
+        return self._last.get(name, default)
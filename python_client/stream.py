@@ -0,0 +1,113 @@
+import binascii
+import message
+
+# Longest run of bytes kept without seeing a '-' delimiter
+MAX_FRAME = 4096
+
+
+class Framer:
+    # Splits raw bytes into '-' delimited frames. Partial frames are kept
+    # until the rest arrives in a later chunk.
+    def __init__(self):
+        self._buf=bytearray()
+        self.errFraming=0
+
+    def clear(self):
+        self._buf=bytearray()
+
+    def frames(self,chunk):
+        self._buf+=chunk
+        end=self._buf.rfind(b'-')
+        if end<0:
+            if len(self._buf)>MAX_FRAME:
+                self.errFraming+=1
+                self._buf=bytearray()
+            return []
+        frames=bytes(self._buf[:end]).split(b'-')
+        del self._buf[:end+1]
+        return frames
+
+
+class Decoder:
+    # Turns frames or raw byte chunks into decoded messages. Only messages
+    # with status ERR_OK are returned, everything else is counted.
+    def __init__(self):
+        self.framer=Framer()
+        self.packets=0
+        self.errFraming=0
+        self.errLength=0
+        self.errHeader=0
+        self.errChecksum=0
+
+    def decode(self,frame):
+        if len(frame)==0:
+            self.errFraming+=1
+            return None
+        m=message.Message()
+        try:
+            m.decode(frame)
+        except binascii.Error:
+            self.errFraming+=1
+            return None
+        if m.status==m.ERR_OK:
+            self.packets+=1
+            return m
+        if m.status==m.ERR_LENGTH: self.errLength+=1
+        elif m.status==m.ERR_HEADER: self.errHeader+=1
+        elif m.status==m.ERR_CHECKSUM: self.errChecksum+=1
+        return None
+
+    def items(self,frames):
+        # Like messages(), but runs of DATA sized frames are decoded together
+        # and yielded as one message.DATA_DTYPE record array
+        run=[]
+        for frame in frames:
+            if len(frame)==message.DATA_FRAME_SIZE:
+                run.append(frame)
+                continue
+            if run:
+                yield from self._dataRun(run)
+                run=[]
+            m=self.decode(frame)
+            if m is not None:
+                yield m
+        if run:
+            yield from self._dataRun(run)
+
+    def _dataRun(self,run):
+        rec,ok=message.decodeDataArray(run)
+        n=int(ok.sum())
+        self.packets+=n
+        if n>0:
+            yield rec[ok]
+        if n<len(run):
+            # other packets that happen to be the same size, or bad ones
+            yield from self.messages([f for f,o in zip(run,ok) if not o])
+
+    def messages(self,frames):
+        for frame in frames:
+            m=self.decode(frame)
+            if m is not None:
+                yield m
+
+    def feed(self,chunk):
+        yield from self.messages(self.framer.frames(chunk))
+
+    def stream(self,chunks):
+        for chunk in chunks:
+            yield from self.feed(chunk)
+
+    def errors(self):
+        return { 'framing'  : self.errFraming+self.framer.errFraming,
+                 'length'   : self.errLength,
+                 'header'   : self.errHeader,
+                 'checksum' : self.errChecksum }
+
+
+def readChunks(f,size=4096):
+    # Chunks from anything with read(), until it returns nothing
+    while True:
+        chunk=f.read(size)
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import math
+import time
+import base64
+import argparse
+sys.path.append("python_client")
+os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+import numpy
+import message
+import comm
+import npfifo
+import device_config
+import ambu_control
+
+# Acquisition pipeline benchmarks, no board needed. Run from the top of the
+# repo:
+#
+#   python tests/benchmark.py                # compare with the baseline
+#   python tests/benchmark.py --save         # store a new baseline
+#
+# Exits with 1 when a result is worse than the baseline by more than the
+# tolerance.
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),"benchmark_baseline.json")
+
+
+def makeFrames(n, rate=100):
+    # n DATA frames with CONFIG, VERSION and CPU_ID once a second, as the
+    # firmware sends them
+    m=message.Message()
+    dev=device_config.DeviceConfig(cpuid=(1,2,3,4),version=b'benchmark')
+    out=[]
+    count=0
+    for i in range(n):
+        millis=i*1000//rate
+        if i%rate==0:
+            out.extend(dev.frames(millis))
+        if i%(3*rate)==0: count+=1
+        phase=(i%(3*rate))/rate
+        press=5+25*math.sin(math.pi*phase) if phase<1 else 5.
+        out.append(m.writeData(m.DATA,millis,[400.,30.,press,10*math.cos(math.pi*phase),phase*100],
+                               [count,(1 if phase<1 else 0)<<24]))
+    return out
+
+
+class MemorySerial:
+    # pyserial stand-in over a byte string, at most chunk bytes per read
+    def __init__(self, data, chunk=256):
+        self._data=data
+        self._pos=0
+        self._chunk=chunk
+
+    @property
+    def in_waiting(self):
+        return min(len(self._data)-self._pos,self._chunk)
+
+    def read(self, size=1):
+        out=self._data[self._pos:self._pos+size]
+        self._pos+=len(out)
+        return out
+
+    def write(self, data):
+        pass
+
+    def done(self):
+        return self._pos>=len(self._data)
+
+
+class MemoryComm:
+    # Stands in for comm.Comm, hands out frames in bursts and stops the
+    # owning AmbuControl when they run out
+    def __init__(self, frames, burst=32):
+        self._frames=[f[:-1] for f in frames]
+        self._burst=burst
+        self._pos=0
+        self.owner=None
+
+    def readPackets(self):
+        if self._pos>=len(self._frames):
+            if self.owner is not None: self.owner._runEn=False
+            return []
+        out=self._frames[self._pos:self._pos+self._burst]
+        self._pos+=len(out)
+        return out
+
+    def write(self, data):
+        pass
+
+
+def best(fn, repeat):
+    # Lowest time of repeat runs, the least disturbed by everything else
+    times=[]
+    for i in range(repeat):
+        t=time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-t)
+    return min(times)
+
+
+def benchDecode(frames, repeat):
+    data=[f[:-1] for f in frames]
+    def run():
+        for f in data:
+            message.Message().decode(f)
+    return len(data)/best(run,repeat)
+
+
+def benchWriteData(n, repeat):
+    m=message.Message()
+    floats=[400.,30.,12.5,-3.25,150.]
+    def run():
+        for i in range(n):
+            m.writeData(m.DATA,i,floats,[i,0])
+    return n/best(run,repeat)
+
+
+def benchFletcher(n, repeat):
+    m=message.Message()
+    data=[base64.b64decode(f[:-1])[:-2] for f in makeFrames(n)[:n]]
+    def run():
+        for d in data:
+            m._fletcher16(d)
+    return len(data)/best(run,repeat)
+
+
+def benchFraming(frames, repeat):
+    raw=b''.join(frames)
+    def run():
+        c=comm.Comm()
+        c._ser=ser=MemorySerial(raw)
+        while not ser.done():
+            c.readPackets()
+    return len(frames)/best(run,repeat)
+
+
+def benchAppend(n, repeat):
+    fifo=npfifo.npfifo(5,6000,6000)
+    row=[float(i) for i in range(5)]
+    def run():
+        for i in range(n):
+            fifo.append(row)
+    return n/best(run,repeat)
+
+
+def benchGetData(n, repeat):
+    fifo=npfifo.npfifo(5,6000,6000)
+    fifo.append_many(numpy.ones((5,6000)))
+    def run():
+        for i in range(n):
+            fifo.get_data()
+    return n/best(run,repeat)
+
+
+def benchHandleSerial(frames, repeat):
+    def run():
+        ser=MemoryComm(frames)
+        ambu=ambu_control.AmbuControl(ser)
+        ser.owner=ambu
+        ambu._runEn=True
+        ambu._handleSerial()
+    return len(frames)/best(run,repeat)
+
+
+def benchPlot(nFrames, repeat):
+    # Returns ms per frame for updatePlot alone and with the repaint
+    try:
+        from PyQt5.QtWidgets import QApplication
+        import control_gui
+    except ImportError as e:
+        print(f"Skipping plot benchmarks: {e}")
+        return None, None
+    app=QApplication.instance() or QApplication(sys.argv[:1])
+    ambu=ambu_control.AmbuControl(MemoryComm([]))
+    gui=control_gui.ControlGui(ambu=ambu)
+    gui.resize(1200,800)
+    gui.show()
+    app.processEvents()
+    block=numpy.zeros((5,6000))
+    block[0]=numpy.arange(6000)/100.
+    ambu._data.append_many(block)
+    step=numpy.zeros((5,8))
+    thresholds=[(0.,-2.,40.,200.,0.),(30.,-2.,35.,200.,0.)]
+    def run(render):
+        for i in range(nFrames):
+            step[0]=ambu._data.get_last_time()+numpy.arange(1,9)/100.
+            step[2]=numpy.sin(step[0])
+            ambu._data.append_many(step)
+            gui.updatePlot(ambu._data.snapshot(),thresholds)
+            if render: gui.gl.grab()
+    update=best(lambda: run(False),repeat)*1000/nFrames
+    render=best(lambda: run(True),repeat)*1000/nFrames
+    gui.close()
+    return update, render
+
+
+def runAll(quick=False):
+    scale=10 if quick else 1
+    repeat=3 if quick else 5
+    frames=makeFrames(20000//scale)
+    results={}
+    def add(name, value, unit, higher):
+        if value is None: return
+        results[name]={'value':value,'unit':unit,'higher':higher}
+        print(f"{name:24s} {value:14.1f} {unit}")
+    add('message_decode',   benchDecode(frames,repeat),               'packets/s',True)
+    add('message_writeData',benchWriteData(20000//scale,repeat),      'packets/s',True)
+    add('fletcher16',       benchFletcher(20000//scale,repeat),       'packets/s',True)
+    add('comm_framing',     benchFraming(frames,repeat),              'packets/s',True)
+    add('npfifo_append',    benchAppend(20000//scale,repeat),         'samples/s',True)
+    add('npfifo_get_data',  benchGetData(2000//scale,repeat),         'calls/s',  True)
+    add('handle_serial',    benchHandleSerial(frames,repeat),         'packets/s',True)
+    update,render=benchPlot(max(100//scale,10),repeat)
+    add('gui_updatePlot',   update,                                   'ms/frame', False)
+    add('gui_render',       render,                                   'ms/frame', False)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # A result regresses when it is worse than the baseline by more than
+    # tolerance, as a fraction of the baseline
+    failed=[]
+    for name,r in results.items():
+        if name not in baseline: continue
+        base=baseline[name]['value']
+        if r['higher']:
+            change=r['value']/base-1
+        else:
+            change=base/r['value']-1
+        status='ok'
+        if change < -tolerance:
+            status='REGRESSION'
+            failed.append(name)
+        print(f"{name:24s} {r['value']:14.1f} {base:14.1f} {r['unit']:10s} {change*100:+7.1f}% {status}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Acquisition pipeline benchmarks')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline JSON to compare with')
+    parser.add_argument('--out', default='benchmark_results.json', help='where to save the results')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed slowdown, fraction of the baseline')
+    parser.add_argument('--quick', action='store_true', help='smaller runs, for a smoke test')
+    args = parser.parse_args()
+
+    results=runAll(args.quick)
+    out={'time':time.time(),'python':sys.version.split()[0],'results':results}
+    with open(args.out,'w') as f:
+        json.dump(out,f,indent=2)
+
+    if args.save:
+        with open(args.baseline,'w') as f:
+            json.dump(out,f,indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create one")
+        sys.exit(0)
+    with open(args.baseline) as f:
+        baseline=json.load(f)['results']
+    print()
+    print(f"{'':24s} {'result':>14s} {'baseline':>14s}")
+    failed=compare(results,baseline,args.tolerance)
+    if failed:
+        print(f"Regressions: {', '.join(failed)}")
+        sys.exit(1)